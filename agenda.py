@@ -0,0 +1,68 @@
+"""Индекс сроков повторений по пользователям для /today
+
+Для каждого пользователя хранится отсортированный список
+(срок, id темы, номер повторения) его невыполненных повторений. Выборка
+«всё, что наступит до момента T» - это бинарный поиск и срез:
+O(log n + k), где k - число найденных повторений, без обхода всех тем.
+
+Список пользователя строится при первом запросе и дальше поддерживается
+при каждом сохранении темы (добавление, выполнение, перенос сроков),
+поэтому не устаревает. Вставка и удаление записи - бинарный поиск плюс
+сдвиг хвоста списка, что для списков в тысячи элементов быстрее любой
+древовидной структуры на Python.
+"""
+from bisect import bisect_left, bisect_right, insort
+
+_AFTER = (float('inf'), float('inf'))
+
+
+class DueIndex:
+    def __init__(self):
+        self._items = {}  # user_id -> [(срок, id темы, номер повторения)]
+        self._topics = {}  # (user_id, id темы) -> записи темы в списке
+
+    def __contains__(self, user_id):
+        return user_id in self._items
+
+    def build(self, user_id, topics):
+        """Строит список пользователя по всем его темам"""
+        items = []
+        for topic in topics:
+            entries = tuple((due_ts, topic.id, index) for index, due_ts in topic.pending())
+            self._topics[(user_id, topic.id)] = entries
+            items.extend(entries)
+        items.sort()
+        self._items[user_id] = items
+
+    def update(self, user_id, topic):
+        """Приводит записи темы в соответствие с её текущими сроками"""
+        items = self._items.get(user_id)
+        if items is None:
+            return
+        key = (user_id, topic.id)
+        old = self._topics.get(key, ())
+        new = tuple((due_ts, topic.id, index) for index, due_ts in topic.pending())
+        if old == new:
+            return
+        for entry in old:
+            position = bisect_left(items, entry)
+            if position < len(items) and items[position] == entry:
+                del items[position]
+        for entry in new:
+            insort(items, entry)
+        self._topics[key] = new
+
+    def due(self, user_id, until_ts):
+        """Повторения со сроком не позже until_ts, по возрастанию срока"""
+        items = self._items.get(user_id, [])
+        return items[:bisect_right(items, (until_ts, *_AFTER))]
+
+    def next_after(self, user_id, ts):
+        """Первое повторение со сроком позже ts или None"""
+        items = self._items.get(user_id, [])
+        position = bisect_right(items, (ts, *_AFTER))
+        return items[position] if position < len(items) else None
+
+    def clear(self):
+        self._items.clear()
+        self._topics.clear()
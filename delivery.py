@@ -0,0 +1,201 @@
+"""Очередь исходящих сообщений с ограничением скорости
+
+Telegram допускает около 30 сообщений в секунду на бота и примерно одно в
+секунду в один чат. Все напоминания проходят через DeliveryQueue:
+общий token bucket, пауза между сообщениями в один чат, ограниченное число
+одновременных отправок и повтор при RetryAfter и сетевых ошибках.
+Напоминания одному пользователю, наступившие в пределах короткого окна,
+склеиваются в одно сообщение, но не больше MAX_BATCH в каждом: остальные
+уходят следующими сообщениями того же окна.
+"""
+import asyncio
+import random
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from metrics import LAG_BUCKETS, Counter, Histogram
+
+GLOBAL_RATE = 30          # сообщений в секунду на бота
+PER_CHAT_INTERVAL = 1.0   # секунд между сообщениями в один чат
+COALESCE_WINDOW = 2.0     # секунд на склейку напоминаний одного пользователя
+MAX_BATCH = 10            # напоминаний в одном сообщении (4096 символов, кнопки)
+CONCURRENCY = 8           # одновременных запросов к Bot API
+MAX_ATTEMPTS = 5
+MAX_BACKOFF = 30
+
+MESSAGES_SENT = Counter('bot_messages_sent_total', "Доставленные сообщения")
+SEND_FAILURES = Counter('bot_send_failures_total', "Неудачные попытки отправки", ['reason'])
+SEND_GIVEN_UP = Counter('bot_send_given_up_total', "Сообщения, которые не удалось доставить")
+DELIVERY_WAIT = Histogram('bot_delivery_wait_seconds', "Время от постановки в очередь до доставки", buckets=LAG_BUCKETS)
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity в запасе
+
+    Запас не меньше одного токена: при rate < 1 (много воркеров делят
+    общий лимит) иначе ни одна отправка не дождалась бы целого токена.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(capacity or rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatThrottle:
+    """Минимальный интервал между сообщениями в один чат"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next_slot = {}
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        slot = max(now, self._next_slot.get(chat_id, 0))
+        self._next_slot[chat_id] = slot + self.interval
+        if len(self._next_slot) > 10000:
+            self._next_slot = {c: t for c, t in self._next_slot.items() if t > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def _retry_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class DeliveryQueue:
+    """Исходящая очередь сообщений бота
+
+    render(items) -> (text, kwargs) собирает одно сообщение из не более
+    чем batch_size напоминаний, накопленных для пользователя за окно склейки.
+    """
+
+    def __init__(self, bot, render, rate=GLOBAL_RATE, chat_interval=PER_CHAT_INTERVAL,
+                 coalesce_window=COALESCE_WINDOW, concurrency=CONCURRENCY, batch_size=MAX_BATCH):
+        self.bot = bot
+        self.render = render
+        self.coalesce_window = coalesce_window
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.sent = 0
+        self.failed = 0
+        self._bucket = TokenBucket(rate)
+        self._throttle = ChatThrottle(chat_interval)
+        self._queue = asyncio.Queue()
+        self._pending = {}
+        self._timers = {}
+        self._workers = []
+
+    def __len__(self):
+        return self._queue.qsize() + sum(len(items) for items in self._pending.values())
+
+    def add_reminder(self, chat_id, item):
+        """Добавляет напоминание; отправка - по истечении окна склейки"""
+        items = self._pending.setdefault(chat_id, [])
+        items.append(item)
+        if len(items) == 1:
+            loop = asyncio.get_running_loop()
+            self._timers[chat_id] = loop.call_later(self.coalesce_window, self._flush, chat_id)
+
+    def send(self, chat_id, text, **kwargs):
+        """Ставит готовое сообщение в очередь без склейки"""
+        self._queue.put_nowait((chat_id, text, kwargs, time.monotonic()))
+
+    def _flush(self, chat_id):
+        self._timers.pop(chat_id, None)
+        items = self._pending.pop(chat_id, None) or []
+        for start in range(0, len(items), self.batch_size):
+            try:
+                text, kwargs = self.render(items[start:start + self.batch_size])
+            except Exception as e:
+                self._give_up(chat_id, e)
+                continue
+            self.send(chat_id, text, **kwargs)
+
+    @property
+    def running(self):
+        return any(not worker.done() for worker in self._workers)
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, timeout=10):
+        """Отправляет накопленное и останавливает воркеров"""
+        for chat_id in list(self._pending):
+            timer = self._timers.pop(chat_id, None)
+            if timer:
+                timer.cancel()
+            self._flush(chat_id)
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Не отправлено {self._queue.qsize()} сообщений при остановке")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs, enqueued_at = await self._queue.get()
+            try:
+                if await self._deliver(chat_id, text, kwargs):
+                    self.sent += 1
+                    MESSAGES_SENT.inc()
+                    DELIVERY_WAIT.observe(time.monotonic() - enqueued_at)
+                else:
+                    self.failed += 1
+                    SEND_GIVEN_UP.inc()
+            except Exception as e:
+                # Любая другая ошибка (ChatMigrated, EndPointNotFound, ...)
+                # стоит одного сообщения, а не воркера
+                self._give_up(chat_id, e)
+            finally:
+                self._queue.task_done()
+
+    def _give_up(self, chat_id, error):
+        SEND_FAILURES.inc(reason='error')
+        self.failed += 1
+        SEND_GIVEN_UP.inc()
+        print(f"❌ Напоминание пользователю {chat_id} не доставлено: {error!r}")
+
+    async def _deliver(self, chat_id, text, kwargs):
+        for attempt in range(MAX_ATTEMPTS):
+            await self._throttle.acquire(chat_id)
+            await self._bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                print(f"✅ Напоминание отправлено пользователю {chat_id}")
+                return True
+            except RetryAfter as e:
+                SEND_FAILURES.inc(reason='rate_limited')
+                delay = _retry_seconds(e)
+                print(f"⏳ Лимит Telegram, повтор через {delay:.0f} с (чат {chat_id})")
+            except (Forbidden, BadRequest) as e:
+                SEND_FAILURES.inc(reason='rejected')
+                print(f"❌ Ошибка отправки напоминания {chat_id}: {e}")
+                return False
+            except NetworkError as e:
+                SEND_FAILURES.inc(reason='network')
+                delay = min(2 ** attempt, MAX_BACKOFF) * (0.5 + random.random())
+                print(f"⚠️ Сетевая ошибка ({e}), повтор через {delay:.1f} с (чат {chat_id})")
+            await asyncio.sleep(delay)
+        print(f"❌ Напоминание пользователю {chat_id} не доставлено после {MAX_ATTEMPTS} попыток")
+        return False
@@ -1,15 +1,33 @@
 import os
+import asyncio
+import atexit
+import functools
+import io
+import hmac
 import logging
-import json
+import signal
 import threading
 import time
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 from datetime import datetime, timedelta
-from flask import Flask, jsonify
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.date import DateTrigger
-import pytz  # Добавляем для работы с часовыми поясами
+from flask import Flask, Response, jsonify, request
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest
+from telegram.helpers import escape_markdown
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters, ContextTypes
+from agenda import DueIndex
+from delivery import GLOBAL_RATE, DeliveryQueue
+from metrics import LAG_BUCKETS, REGISTRY, Counter, Gauge, Histogram
+from model import MOSCOW_TZ, Topic, from_timestamp
+from persistence import DialogPersistence, WriteBehind
+from reminders import ReminderQueue
+from sharding import ShardLease, shard_of, update_user_id
+from srs import get_algorithm
+from storage import open_storage
+from transfer import MAX_BYTES, MAX_ERRORS, TransferError, export_csv, export_json, parse_import
 
 # Настройка логирования
 logging.basicConfig(
@@ -17,15 +35,40 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-# Московский часовой пояс
-MOSCOW_TZ = pytz.timezone('Europe/Moscow')
-
 # Создаем Flask приложение для порта
 app = Flask(__name__)
 
 # Глобальные переменные
 user_data = {}
+topics_by_id = {}  # user_id -> {id темы: тема}
 scheduler = None
+catchup = None  # Сводки пропущенных за время простоя повторений
+delivery = None
+storage = None
+writer = None
+shard_lease = None
+# Кэш отрисованных страниц /list и /done: user_id -> {вид: [страницы]}
+view_cache = {}
+# Отсортированные сроки невыполненных повторений по пользователям (для /today)
+due_index = DueIndex()
+# Запущенный Application и его event loop (для webhook и /health)
+bot_application = None
+bot_loop = None
+update_mode = None  # 'polling' или 'webhook'
+last_update_ts = None
+
+# Метрики для /metrics
+UPDATE_SECONDS = Histogram('bot_update_seconds', "Время обработки обновления", ['handler'])
+UPDATE_ERRORS = Counter('bot_update_errors_total', "Ошибки в обработчиках", ['handler'])
+REMINDER_LAG = Histogram('bot_reminder_lag_seconds', "Опоздание срабатывания напоминания относительно срока", buckets=LAG_BUCKETS)
+Gauge('bot_reminders_pending', "Запланированные напоминания", function=lambda: len(scheduler) if scheduler else 0)
+Gauge('bot_catchup_pending', "Сводки пропущенных повторений, ожидающие отправки", function=lambda: len(catchup) if catchup else 0)
+Gauge('bot_delivery_queue_size', "Сообщения в очереди отправки", function=lambda: len(delivery) if delivery else 0)
+Gauge('bot_persistence_dirty', "Изменённые темы, ожидающие записи", function=lambda: len(writer) if writer else 0)
+Gauge('bot_shard_lease_held', "Аренда шарда действует (1) или нет (0)", function=lambda: int(shard_lease.held) if shard_lease else None)
+Gauge('bot_users_loaded', "Пользователи, загруженные в память", function=lambda: len(user_data))
+Gauge('bot_peak_rss_megabytes', "Пиковый RSS процесса", function=lambda: peak_rss_mb())
+STARTUP_SECONDS = Gauge('bot_startup_seconds', "Длительность этапов запуска", ['stage'])
 
 @app.route('/')
 def home():
@@ -37,14 +80,101 @@ def ping():
 
 @app.route('/health')
 def health():
-    return jsonify({"status": "healthy", "bot": "running", "timestamp": datetime.now().isoformat()}), 200
+    application = bot_application
+    if update_mode == 'polling':
+        updates_alive = bool(application and application.updater and application.updater.running)
+    else:
+        updates_alive = bool(application and application.running)
+    checks = {
+        'updates': updates_alive,
+        'scheduler': scheduler is not None and scheduler.running,
+        'delivery': delivery is not None and delivery.running,
+    }
+    if SHARD:
+        checks['shard_lease'] = bool(shard_lease and shard_lease.held)
+    healthy = all(checks.values())
+    return jsonify({
+        "status": "healthy" if healthy else "degraded",
+        "mode": update_mode,
+        "shard": f"{SHARD_INDEX}/{SHARD_COUNT}" if SHARD else None,
+        "checks": checks,
+        "reminders_pending": len(scheduler) if scheduler else 0,
+        "catchup_pending": len(catchup) if catchup else 0,
+        "last_update_seconds_ago": round(time.time() - last_update_ts, 1) if last_update_ts else None,
+        "timestamp": datetime.now().isoformat()
+    }), 200 if healthy else 503
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/telegram', methods=['POST'])
+def telegram_webhook():
+    """Приём обновлений Telegram в режиме webhook или от диспетчера шардов"""
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not WEBHOOK_SECRET or not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return "forbidden", 403
+    
+    application, loop = bot_application, bot_loop
+    if application is None or loop is None or update_mode not in ('webhook', 'worker'):
+        return "not ready", 503
+    
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return "bad request", 400
+    
+    # Воркер обслуживает только пользователей своего шарда
+    user_id = update_user_id(data)
+    if SHARD and user_id is not None and shard_of(user_id, SHARD_COUNT) != SHARD_INDEX:
+        return "wrong shard", 421
+    
+    # Передаём обновление прямо в очередь Application на его event loop
+    update = Update.de_json(data, application.bot)
+    asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop)
+    return "ok", 200
 
 def run_flask():
     """Запускает Flask сервер в отдельном потоке"""
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    app.run(host='0.0.0.0', port=PORT, debug=False, threaded=True)
 
 # Константы
-DATA_FILE = "user_data.json"
+DATA_FILE = "user_data.json"  # Старый формат, переносится в SQLite при первом запуске
+DB_FILE = os.getenv('DB_FILE', 'user_data.db')
+BOT_API_URL = os.getenv('BOT_API_URL')  # Например, локальный Bot API сервер для тестов
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')  # 'sqlite' или 'json'
+# Ленивый старт: при запуске читаются только темы с невыполненными повторениями,
+# полный список тем пользователя подгружается при первом обращении
+LAZY_STARTUP = os.getenv('LAZY_STARTUP', '1') == '1'
+PORT = int(os.getenv('PORT', '5000'))
+# Режим webhook: Telegram присылает обновления на WEBHOOK_URL + /telegram.
+# Без WEBHOOK_URL бот работает через long polling.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Режим воркера (см. sharding.py): процесс обслуживает пользователей с
+# user_id % SHARD_COUNT == SHARD_INDEX, обновления пересылает диспетчер
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+SHARD = (SHARD_COUNT, SHARD_INDEX) if SHARD_COUNT > 1 else None
+# Напоминания, наступившие, пока аренда шарда не продлена, откладываются
+# на столько секунд, а не теряются
+LEASE_RETRY = 5.0
+# Постраничный вывод: Telegram ограничивает сообщение 4096 символами
+PAGE_SIZE = 10
+PAGE_CHAR_LIMIT = 3500
+# Догонялка после простоя: сводки пропущенных повторений рассылаются не
+# разом, а растягиваются на CATCHUP_WINDOW секунд (не реже одной в секунду).
+# Сводки занимают не больше CATCHUP_RATE_SHARE лимита отправки, чтобы
+# свежие напоминания не ждали за ними в очереди; если пользователей много,
+# рассылка длится дольше окна. Догоняются все пропущенные повторения:
+# сводка всё равно показывает не больше CATCHUP_DIGEST_LIMIT строк. Если
+# задан CATCHUP_MAX_AGE (секунд), более старые не догоняются, и их число
+# выводится в лог.
+CATCHUP_WINDOW = float(os.getenv('CATCHUP_WINDOW', '300'))
+CATCHUP_MAX_AGE = int(os.getenv('CATCHUP_MAX_AGE', '0'))
+CATCHUP_SPACING = 1.0
+CATCHUP_RATE_SHARE = 0.5
+CATCHUP_DIGEST_LIMIT = 20
+TODAY_LIMIT = 20  # Сколько повторений показывать в /today
 INTERVALS = [
     timedelta(minutes=30),
     timedelta(days=1),
@@ -52,6 +182,10 @@ INTERVALS = [
     timedelta(days=8),
     timedelta(days=30)
 ]
+# Алгоритм повторений: 'sm2' - сроки подстраиваются под фактическое
+# выполнение и оценку, 'fixed' - строго по INTERVALS от даты изучения
+SRS_ALGORITHM = os.getenv('SRS_ALGORITHM', 'sm2')
+algorithm = get_algorithm(SRS_ALGORITHM, INTERVALS)
 
 def get_moscow_time():
     """Возвращает текущее время в Московском часовом поясе"""
@@ -65,136 +199,463 @@ def parse_moscow_time(date_string):
     except ValueError:
         raise ValueError("Неверный формат даты")
 
+def format_time(ts):
+    """Форматирует время epoch как ДД.ММ.ГГГГ ЧЧ:ММ по Москве"""
+    return from_timestamp(ts).strftime('%d.%m.%Y %H:%M')
+
+def get_storage():
+    """Открывает хранилище при первом обращении"""
+    global storage
+    if storage is None:
+        storage = open_storage(STORAGE_BACKEND, DB_FILE, DATA_FILE)
+    return storage
+
+def get_writer():
+    """Отложенная запись поверх хранилища"""
+    global writer
+    if writer is None:
+        writer = WriteBehind(get_storage())
+    return writer
+
+def flush_on_exit():
+    """Сохраняет несохранённые темы при выходе из процесса"""
+    if writer is not None and len(writer):
+        try:
+            print(f"💾 Сохранено {writer.flush_sync()} тем при выходе")
+        except Exception as e:
+            print(f"❌ Ошибка при сохранении данных: {e}")
+
+def peak_rss_mb():
+    """Пиковый RSS процесса в МиБ (None, если недоступно)"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def report_startup(stage, started):
+    """Печатает длительность этапа запуска и пиковую память, отдаёт их в /metrics"""
+    elapsed = time.perf_counter() - started
+    rss = peak_rss_mb()
+    STARTUP_SECONDS.set(elapsed, stage=stage)
+    rss_text = f", пиковая память {rss:.0f} МиБ" if rss else ""
+    print(f"⏱️ {stage}: {elapsed:.2f} с{rss_text}")
+
 def load_data():
-    """Загрузка данных из файла"""
+    """Загрузка данных из хранилища"""
     global user_data
+    started = time.perf_counter()
+    due_index.clear()
     try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                for user_id_str, topics in data.items():
-                    user_id = int(user_id_str)
-                    user_data[user_id] = []
-                    for topic in topics:
-                        # Загружаем даты с учетом часового пояса
-                        study_date = datetime.fromisoformat(topic['study_date'])
-                        if study_date.tzinfo is None:
-                            study_date = MOSCOW_TZ.localize(study_date)
-                        
-                        topic_data = {
-                            'topic': topic['topic'],
-                            'study_date': study_date,
-                            'repetitions': [
-                                {
-                                    'date': MOSCOW_TZ.localize(datetime.fromisoformat(rep['date'])) if datetime.fromisoformat(rep['date']).tzinfo is None else datetime.fromisoformat(rep['date']),
-                                    'completed': rep['completed']
-                                }
-                                for rep in topic['repetitions']
-                            ]
-                        }
-                        user_data[user_id].append(topic_data)
-            print(f"✅ Данные загружены из {DATA_FILE}")
+        if LAZY_STARTUP:
+            # Темы подгружаются по пользователям через get_topics()
+            user_data = {}
+            get_storage()
+            print(f"✅ Хранилище открыто ({STORAGE_BACKEND}), темы загружаются по запросу")
         else:
-            print("📁 Файл данных не найден, начинаем с чистого листа")
             user_data = {}
+            for user_id, records in get_storage().load(SHARD).items():
+                cache_user(user_id, [Topic.from_record(record) for record in records])
+            print(f"✅ Данные загружены ({STORAGE_BACKEND}): {len(user_data)} пользователей")
     except Exception as e:
         print(f"❌ Ошибка при загрузке данных: {e}")
         user_data = {}
+    report_startup('load_data', started)
 
-def save_data():
-    """Сохранение данных в файл"""
-    try:
-        data_to_save = {}
+def cache_user(user_id, topics):
+    """Кладёт темы пользователя в память вместе с индексом по id"""
+    user_data[user_id] = topics
+    topics_by_id[user_id] = {topic.id: topic for topic in topics}
+    return topics
+
+def get_topics(user_id):
+    """Темы пользователя; при ленивом старте подгружаются при первом обращении"""
+    topics = user_data.get(user_id)
+    if topics is None:
+        topics = cache_user(user_id, [Topic.from_record(record) for record in get_storage().load_user(user_id)])
+    return topics
+
+def find_topic(user_id, topic_id):
+    """Тема пользователя по её постоянному id или None"""
+    get_topics(user_id)
+    return topics_by_id[user_id].get(topic_id)
+
+def ensure_due_index(user_id):
+    """Строит индекс сроков пользователя при первом обращении"""
+    if user_id not in due_index:
+        due_index.build(user_id, get_topics(user_id))
+
+def add_topic(user_id, name, study_date):
+    """Создает тему со следующим свободным id"""
+    topics = get_topics(user_id)
+    topic = Topic.create(topics[-1].id + 1 if topics else 1, name, study_date, INTERVALS)
+    topics.append(topic)
+    topics_by_id[user_id][topic.id] = topic
+    return topic
+
+def skip_past_repetitions(topic, now):
+    """Прошедшие на момент добавления сроки не догоняются сводкой после простоя"""
+    for rep_index, rep_ts in topic.pending():
+        if rep_ts <= now:
+            topic.mark_notified(rep_index)
+
+def import_topics(application, user_id, rows):
+    """Добавляет темы пачкой: одна запись в хранилище и одна вставка в очередь напоминаний
+
+    rows - [(название, дата изучения, выполненные повторения, сроки или None)]
+    из parse_import. Выполненные повторения и сроки из выгрузки
+    восстанавливаются. Темы, которые уже есть у пользователя (то же название
+    и время изучения), пропускаются, так что повторный импорт выгрузки
+    ничего не дублирует. Возвращает (добавлено, пропущено).
+    """
+    topics = get_topics(user_id)
+    existing = {(topic.name, topic.study_ts) for topic in topics}
+    next_id = topics[-1].id + 1 if topics else 1
+    now = time.time()
+    added = []
+    for name, study_date, completed, rep_dates in rows:
+        key = (name, int(study_date.timestamp()))
+        if key in existing:
+            continue
+        existing.add(key)
+        topic = Topic.create(next_id, name, study_date, INTERVALS)
+        next_id += 1
+        for index, rep_date in enumerate((rep_dates or [])[:len(topic)]):
+            topic.rep_ts[index] = int(rep_date.timestamp())
+        for index in completed:
+            if index < len(topic):
+                topic.mark_done(index)
+        skip_past_repetitions(topic, now)
+        added.append(topic)
+    
+    topics.extend(added)
+    topics_by_id[user_id].update((topic.id, topic) for topic in added)
+    save_topics(user_id, added)
+    if scheduler is not None:
+        scheduler.extend(
+            ((user_id, topic.id, rep_index), due_ts, application)
+            for topic in added
+            for rep_index, due_ts in topic.pending()
+            if due_ts > now
+        )
+    return len(added), len(rows) - len(added)
+
+def iter_pending_topics():
+    """(user_id, тема) для тем с невыполненными повторениями"""
+    if not LAZY_STARTUP:
         for user_id, topics in user_data.items():
-            data_to_save[str(user_id)] = []
             for topic in topics:
-                topic_data = {
-                    'topic': topic['topic'],
-                    'study_date': topic['study_date'].isoformat(),
-                    'repetitions': [
-                        {
-                            'date': rep['date'].isoformat(),
-                            'completed': rep['completed']
-                        }
-                        for rep in topic['repetitions']
-                    ]
-                }
-                data_to_save[str(user_id)].append(topic_data)
-        
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=2)
-        print(f"💾 Данные сохранены в {DATA_FILE}")
+                yield user_id, topic
+        return
+    for user_id, record in get_storage().load_pending(SHARD):
+        # Уже загруженные пользователи могли измениться в памяти
+        if user_id not in user_data:
+            yield user_id, Topic.from_record(record)
+    for user_id, topics in user_data.items():
+        for topic in topics:
+            yield user_id, topic
+
+def save_topic(user_id, topic):
+    """Сохранение одной темы пользователя
+
+    На работающем боте тема попадает в отложенную запись; без event loop
+    (скрипты, тесты) записывается сразу.
+    """
+    invalidate_view(user_id)
+    due_index.update(user_id, topic)
+    try:
+        get_writer().mark(user_id, topic.to_record())
+        if not writer.running:
+            writer.flush_sync()
     except Exception as e:
-        print(f"❌ Ошибка при сохранении данных: {e}")
+        print(f"❌ Ошибка при сохранении темы: {e}")
 
-async def send_reminder(application, user_id, topic_name, repetition_date, repetition_number):
-    """Отправка напоминания пользователю"""
+def save_topics(user_id, topics):
+    """Сохранение многих тем пользователя одной транзакцией"""
+    invalidate_view(user_id)
     try:
-        # Конвертируем время в московское для отображения
-        moscow_time = repetition_date.astimezone(MOSCOW_TZ)
+        get_writer()
+        for topic in topics:
+            due_index.update(user_id, topic)
+            writer.mark(user_id, topic.to_record())
+        if writer.running:
+            writer.request_flush()
+        else:
+            writer.flush_sync()
+    except Exception as e:
+        print(f"❌ Ошибка при сохранении тем: {e}")
+
+def shorten(text, limit):
+    """Обрезает текст до limit символов с многоточием"""
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+def render_reminders(items):
+    """Напоминание для списка (id темы, тема, время повторения, номер повторения)
+
+    Названия тем набраны пользователем, а сообщение уходит в Markdown,
+    поэтому они экранируются: иначе Telegram отклонит всё сообщение. В
+    сводке нескольких тем длинные названия обрезаются, чтобы MAX_BATCH
+    строк уложились в лимит 4096 символов.
+    """
+    if len(items) == 1:
+        _, topic_name, repetition_ts, repetition_number = items[0]
         
         message = f"🔔 **Напоминание о повторении**\n\n"
-        message += f"📚 Тема: {topic_name}\n"
-        message += f"🕐 Время повторения: {moscow_time.strftime('%d.%m.%Y %H:%M')} (МСК)\n"
+        message += f"📚 Тема: {escape_markdown(shorten(topic_name, 1000))}\n"
+        message += f"🕐 Время повторения: {format_time(repetition_ts)} (МСК)\n"
         message += f"📅 Это повторение №{repetition_number} по методу Эббингауза\n\n"
-        message += "Используйте /done чтобы отметить как выполненное"
-        
-        await application.bot.send_message(
-            chat_id=user_id, 
-            text=message,
-            parse_mode='Markdown'
-        )
-        print(f"✅ Напоминание отправлено пользователю {user_id} для темы '{topic_name}'")
-    except Exception as e:
-        print(f"❌ Ошибка отправки напоминания: {e}")
+    else:
+        message = f"🔔 **Пора повторить темы ({len(items)})**\n\n"
+        for _, topic_name, repetition_ts, repetition_number in items:
+            message += f"📚 {escape_markdown(shorten(topic_name, 100))} - повторение №{repetition_number}, {format_time(repetition_ts)} МСК\n"
+        message += "\n"
+    message += "Нажмите ✅, когда повторите тему"
+    return message, {'parse_mode': 'Markdown', 'reply_markup': done_keyboard(items)}
+
+def render_overdue(items):
+    """Сводка повторений, срок которых прошёл, пока бот не работал"""
+    shown = items[:CATCHUP_DIGEST_LIMIT]
+    message = f"⏰ **Пропущенные повторения ({len(items)})**\n\n"
+    message += "Пока бот был недоступен, подошёл срок этих повторений:\n\n"
+    for _, topic_name, repetition_ts, repetition_number in shown:
+        message += f"📚 {escape_markdown(topic_name)} - повторение №{repetition_number}, {format_time(repetition_ts)} МСК\n"
+    if len(items) > len(shown):
+        message += f"...и ещё {len(items) - len(shown)}, см. /done\n"
+    message += "\nНажмите ✅, когда повторите тему"
+    return message, {'parse_mode': 'Markdown', 'reply_markup': done_keyboard(shown)}
+
+def render_today(items, now, upcoming):
+    """Ответ /today: просроченные и оставшиеся на сегодня повторения
+
+    items - [(id темы, тема, срок, номер повторения)] по возрастанию срока,
+    upcoming - ближайшее повторение после сегодняшних в том же виде или None.
+    """
+    if not items:
+        message = "🎉 На сегодня повторений нет!"
+        if upcoming is not None:
+            _, topic_name, repetition_ts, repetition_number = upcoming
+            message += f"\n\n⏭️ Следующее: {topic_name} - повторение №{repetition_number}, {format_time(repetition_ts)} МСК"
+        return message, {}
+    
+    shown = items[:TODAY_LIMIT]
+    message = f"📅 **Повторения на сегодня ({len(items)})**\n"
+    overdue = [item for item in shown if item[2] <= now]
+    later = shown[len(overdue):]
+    if overdue:
+        message += "\n⏰ Пора повторить:\n"
+        for _, topic_name, repetition_ts, repetition_number in overdue:
+            message += f"📚 {escape_markdown(topic_name)} - повторение №{repetition_number}, {format_time(repetition_ts)} МСК\n"
+    if later:
+        message += "\n🕐 Позже сегодня:\n"
+        for _, topic_name, repetition_ts, repetition_number in later:
+            message += f"📚 {escape_markdown(topic_name)} - повторение №{repetition_number}, {format_time(repetition_ts)} МСК\n"
+    if len(items) > len(shown):
+        message += f"...и ещё {len(items) - len(shown)}, см. /done\n"
+    message += "\nНажмите ✅, когда повторите тему"
+    return message, {'parse_mode': 'Markdown', 'reply_markup': done_keyboard(shown)}
+
+def done_keyboard(items):
+    """Кнопки «✅ Готово» для каждого повторения из напоминания
+
+    Под одиночным напоминанием адаптивный алгоритм добавляет оценку:
+    «Трудно» и «Легко» сближают или раздвигают следующие повторения.
+    """
+    if len(items) == 1:
+        topic_id, _, _, repetition_number = items[0]
+        callback_data = f"rep:{topic_id}:{repetition_number - 1}"
+        if not algorithm.adaptive:
+            return InlineKeyboardMarkup([[InlineKeyboardButton("✅ Готово", callback_data=callback_data)]])
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton("😓 Трудно", callback_data=f"{callback_data}:hard"),
+            InlineKeyboardButton("✅ Готово", callback_data=callback_data),
+            InlineKeyboardButton("😎 Легко", callback_data=f"{callback_data}:easy"),
+        ]])
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"✅ {topic_name[:30]} №{repetition_number}", callback_data=f"rep:{topic_id}:{repetition_number - 1}")]
+        for topic_id, topic_name, _, repetition_number in items
+    ])
+
+def owns_reminders():
+    """Этот процесс вправе отправлять напоминания (у воркера - есть аренда шарда)"""
+    return shard_lease is None or shard_lease.held
+
+async def on_reminder_due(key, due_ts, application):
+    """Срабатывание напоминания из очереди"""
+    if not owns_reminders():
+        scheduler.push(key, time.time() + LEASE_RETRY, application)
+        return
+    REMINDER_LAG.observe(max(time.time() - due_ts, 0))
+    user_id, topic_id, rep_index = key
+    topic = find_topic(user_id, topic_id)
+    if topic is None or topic.is_done(rep_index):
+        return
+    topic.mark_notified(rep_index)
+    save_topic(user_id, topic)
+    delivery.add_reminder(user_id, (topic.id, topic.name, topic.rep_ts[rep_index], rep_index + 1))
+
+async def on_catchup_due(user_id, due_ts, overdue):
+    """Отправка сводки пропущенных повторений одному пользователю"""
+    if not owns_reminders():
+        catchup.push(user_id, time.time() + LEASE_RETRY, overdue)
+        return
+    items = []
+    now = time.time()
+    for queued_ts, topic_id, rep_index in overdue:
+        topic = find_topic(user_id, topic_id)
+        # Пока сводка ждала своей очереди, повторение могли отметить, а
+        # алгоритм - перенести его срок в будущее
+        if topic is None or topic.is_done(rep_index) or topic.is_notified(rep_index):
+            continue
+        if topic.rep_ts[rep_index] != queued_ts or queued_ts > now:
+            continue
+        topic.mark_notified(rep_index)
+        items.append((topic, rep_index))
+    if not items:
+        return
+    for topic in {topic.id: topic for topic, _ in items}.values():
+        save_topic(user_id, topic)
+    text, kwargs = render_overdue([
+        (topic.id, topic.name, topic.rep_ts[rep_index], rep_index + 1) for topic, rep_index in items
+    ])
+    delivery.send(user_id, text, **kwargs)
 
 def schedule_reminders(application):
-    """Планирование всех напоминаний при запуске"""
+    """Планирование всех напоминаний при запуске (вызывается на event loop)"""
     global scheduler
     
     if scheduler is None:
-        scheduler = BackgroundScheduler(timezone=MOSCOW_TZ)  # Указываем московский часовой пояс
-        scheduler.start()
-        print("🕐 Планировщик напоминаний запущен (Московское время)")
+        scheduler = ReminderQueue(on_reminder_due)
     
     # Очищаем старые задания
-    scheduler.remove_all_jobs()
+    scheduler.clear()
     
-    # Планируем напоминания для всех пользователей
-    for user_id, topics in user_data.items():
-        for topic_index, topic in enumerate(topics):
-            for rep_index, repetition in enumerate(topic['repetitions']):
-                if not repetition['completed'] and repetition['date'] > get_moscow_time():
-                    job_id = f"reminder_{user_id}_{topic_index}_{rep_index}"
-                    
-                    scheduler.add_job(
-                        send_reminder,
-                        trigger=DateTrigger(run_date=repetition['date']),
-                        args=[application, user_id, topic['topic'], repetition['date'], rep_index + 1],
-                        id=job_id
-                    )
-                    print(f"📅 Запланировано напоминание: {job_id} на {repetition['date'].strftime('%d.%m.%Y %H:%M')} МСК")
+    started = time.perf_counter()
+    now = time.time()
+    upcoming = []
+    overdue = {}  # user_id -> [(срок, id темы, номер повторения)]
+    stale = 0
+    oldest = now - CATCHUP_MAX_AGE if CATCHUP_MAX_AGE else None
+    for user_id, topic in iter_pending_topics():
+        for rep_index, due_ts in topic.pending():
+            if due_ts > now:
+                upcoming.append(((user_id, topic.id, rep_index), due_ts, application))
+            elif topic.is_notified(rep_index):
+                continue
+            elif oldest is not None and due_ts <= oldest:
+                stale += 1
+            else:
+                overdue.setdefault(user_id, []).append((due_ts, topic.id, rep_index))
+    scheduler.extend(upcoming)
+    scheduler.start()
+    
+    print(f"✅ Запланировано {len(scheduler)} напоминаний (Московское время)")
+    if stale:
+        print(f"⚠️ Не догоняются {stale} повторений старше CATCHUP_MAX_AGE ({CATCHUP_MAX_AGE} с)")
+    schedule_catchup(overdue, now)
+    report_startup('schedule_reminders', started)
+
+def schedule_catchup(overdue, now):
+    """Планирует сводки пропущенных повторений с ограничением всплеска
+
+    Пользователи с самыми старыми пропусками идут первыми; сводки
+    отправляются через равные промежутки, так что вся рассылка укладывается
+    в CATCHUP_WINDOW секунд, но не быстрее CATCHUP_RATE_SHARE лимита
+    отправки этого процесса.
+    """
+    global catchup
+    
+    if catchup is None:
+        catchup = ReminderQueue(on_catchup_due)
     
-    print(f"✅ Запланировано {len(scheduler.get_jobs())} напоминаний")
+    catchup.clear()
+    if overdue:
+        min_spacing = SHARD_COUNT / (GLOBAL_RATE * CATCHUP_RATE_SHARE)
+        spacing = max(min(CATCHUP_WINDOW / len(overdue), CATCHUP_SPACING), min_spacing)
+        users = sorted(overdue, key=lambda user_id: min(overdue[user_id]))
+        catchup.extend(
+            (user_id, now + position * spacing, sorted(overdue[user_id]))
+            for position, user_id in enumerate(users)
+        )
+        total = sum(len(items) for items in overdue.values())
+        print(f"⏰ Пропущено {total} повторений у {len(overdue)} пользователей, сводки уйдут за {spacing * len(overdue):.0f} с")
+    catchup.start()
 
-def schedule_single_reminder(application, user_id, topic_index, rep_index):
+def schedule_single_reminder(application, user_id, topic, rep_index):
     """Планирование одного напоминания"""
     if scheduler is None:
         return
     
-    topic = user_data[user_id][topic_index]
-    repetition = topic['repetitions'][rep_index]
+    due_ts = topic.rep_ts[rep_index]
     
-    if not repetition['completed'] and repetition['date'] > get_moscow_time():
-        job_id = f"reminder_{user_id}_{topic_index}_{rep_index}"
-        
-        scheduler.add_job(
-            send_reminder,
-            trigger=DateTrigger(run_date=repetition['date']),
-            args=[application, user_id, topic['topic'], repetition['date'], rep_index + 1],
-            id=job_id
-        )
-        print(f"📅 Запланировано новое напоминание: {job_id} на {repetition['date'].strftime('%d.%m.%Y %H:%M')} МСК")
+    if not topic.is_done(rep_index) and due_ts > time.time():
+        key = (user_id, topic.id, rep_index)
+        scheduler.push(key, due_ts, application)
+        print(f"📅 Запланировано новое напоминание: {key} на {format_time(due_ts)} МСК")
+
+def cancel_reminder(user_id, topic_id, rep_index):
+    """Отмена запланированного напоминания"""
+    key = (user_id, topic_id, rep_index)
+    if scheduler and scheduler.cancel(key):
+        print(f"🗑️ Удалено напоминание: {key}")
+
+def complete_repetition(application, user_id, topic, rep_index, grade=None):
+    """Отмечает повторение выполненным, сохраняет тему и переносит напоминания
+
+    Алгоритм повторений может сдвинуть следующие сроки: их напоминания
+    перепланируются.
+    """
+    moved = algorithm.complete(topic, rep_index, time.time(), grade)
+    save_topic(user_id, topic)
+    cancel_reminder(user_id, topic.id, rep_index)
+    for index in moved:
+        schedule_single_reminder(application, user_id, topic, index)
+
+async def on_startup(application):
+    """Запуск очереди отправки и диспетчера напоминаний на event loop приложения"""
+    global delivery, bot_application, bot_loop, shard_lease
+    bot_application = application
+    bot_loop = asyncio.get_running_loop()
+    get_writer().start()
+    if SHARD:
+        shard_lease = ShardLease(get_storage(), SHARD_COUNT, SHARD_INDEX)
+        await shard_lease.start()
+    # Лимит Telegram общий на бота, поэтому делится между воркерами
+    delivery = DeliveryQueue(application.bot, render_reminders, rate=GLOBAL_RATE / SHARD_COUNT)
+    delivery.start()
+    schedule_reminders(application)
+
+async def on_stop(application):
+    """Остановка диспетчера напоминаний и досылка очереди отправки"""
+    global bot_application, bot_loop
+    bot_application = None
+    bot_loop = None
+    if scheduler is not None:
+        await scheduler.stop()
+    if catchup is not None:
+        await catchup.stop()
+    if delivery is not None:
+        await delivery.stop()
+    if writer is not None:
+        await writer.stop()
+    if shard_lease is not None:
+        await shard_lease.stop()
+
+def instrumented(handler):
+    """Замер времени и ошибок обработчика для /metrics"""
+    name = handler.__name__
+    
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        global last_update_ts
+        last_update_ts = time.time()
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            UPDATE_ERRORS.inc(handler=name)
+            raise
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started, handler=name)
+    
+    return wrapper
 
 # Существующие функции бота с обновлением для московского времени
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -205,6 +666,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /newtopic - добавить новую тему
 /list - показать все темы
 /done - отметить повторение как выполненное
+/today - что повторить сегодня
+/import - загрузить темы из CSV или JSON
+/export - выгрузить темы в CSV (/export json - в JSON)
 
 🔔 *Новая функция:* автоматические напоминания о повторениях!
 ⏰ *Часовой пояс:* Московское время (UTC+3)
@@ -236,36 +700,19 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             topic = context.user_data['temp_topic']
             
-            if user_id not in user_data:
-                user_data[user_id] = []
-            
-            repetitions = []
-            for interval in INTERVALS:
-                repetition_date = study_date + interval
-                repetitions.append({
-                    'date': repetition_date,
-                    'completed': False
-                })
-            
-            topic_data = {
-                'topic': topic,
-                'study_date': study_date,
-                'repetitions': repetitions
-            }
-            
-            user_data[user_id].append(topic_data)
-            save_data()
+            topic_data = add_topic(user_id, topic, study_date)
+            # Прошедшие сроки пользователь видит в ответе ниже
+            skip_past_repetitions(topic_data, time.time())
+            save_topic(user_id, topic_data)
             
             # Планируем напоминания для новой темы
-            topic_index = len(user_data[user_id]) - 1
             for rep_index in range(len(INTERVALS)):
-                schedule_single_reminder(context.application, user_id, topic_index, rep_index)
+                schedule_single_reminder(context.application, user_id, topic_data, rep_index)
             
             response = f"✅ Тема '{topic}' добавлена!\n\n📅 Расписание повторений (Московское время):\n"
-            for i, rep in enumerate(repetitions, 1):
-                status = "✅" if rep['completed'] else "⏳"
-                moscow_time = rep['date'].astimezone(MOSCOW_TZ) if rep['date'].tzinfo else rep['date']
-                response += f"{i}. {moscow_time.strftime('%d.%m.%Y %H:%M')} {status}\n"
+            for i, rep_ts in enumerate(topic_data.rep_ts):
+                status = "✅" if topic_data.is_done(i) else "⏳"
+                response += f"{i + 1}. {format_time(rep_ts)} {status}\n"
             
             response += "\n🔔 Напоминания запланированы автоматически!"
             
@@ -279,19 +726,18 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif waiting_for == 'topic_choice':
         try:
             topic_index = int(user_text) - 1
-            user_topics = user_data.get(user_id, [])
+            user_topics = get_topics(user_id)
             
             if 0 <= topic_index < len(user_topics):
-                context.user_data['selected_topic_index'] = topic_index
+                topic_data = user_topics[topic_index]
+                context.user_data['selected_topic_id'] = topic_data.id
                 context.user_data['waiting_for'] = 'repetition_choice'
                 
-                topic_data = user_topics[topic_index]
-                response = f"🎯 Тема: {topic_data['topic']}\n\nВыберите номер повторения:\n"
+                response = f"🎯 Тема: {topic_data.name}\n\nВыберите номер повторения:\n"
                 
-                for i, repetition in enumerate(topic_data['repetitions'], 1):
-                    status = "✅" if repetition['completed'] else "❌"
-                    moscow_time = repetition['date'].astimezone(MOSCOW_TZ) if repetition['date'].tzinfo else repetition['date']
-                    response += f"{i}. {moscow_time.strftime('%d.%m.%Y %H:%M')} {status}\n"
+                for i, rep_ts in enumerate(topic_data.rep_ts):
+                    status = "✅" if topic_data.is_done(i) else "❌"
+                    response += f"{i + 1}. {format_time(rep_ts)} {status}\n"
                 
                 await update.message.reply_text(response)
             else:
@@ -303,31 +749,28 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif waiting_for == 'repetition_choice':
         try:
             repetition_index = int(user_text) - 1
-            topic_index = context.user_data['selected_topic_index']
-            user_topics = user_data.get(user_id, [])
+            topic_data = find_topic(user_id, context.user_data['selected_topic_id'])
             
-            if 0 <= repetition_index < len(user_topics[topic_index]['repetitions']):
-                user_topics[topic_index]['repetitions'][repetition_index]['completed'] = True
-                save_data()
-                
-                # Удаляем запланированное напоминание, если оно есть
-                if scheduler:
-                    job_id = f"reminder_{user_id}_{topic_index}_{repetition_index}"
-                    job = scheduler.get_job(job_id)
-                    if job:
-                        job.remove()
-                        print(f"🗑️ Удалено напоминание: {job_id}")
+            if topic_data and 0 <= repetition_index < len(topic_data):
+                # Повторная отметка не должна сдвигать сроки заново
+                already_done = topic_data.is_done(repetition_index)
+                if not already_done:
+                    complete_repetition(context.application, user_id, topic_data, repetition_index)
                 
-                context.user_data.pop('selected_topic_index', None)
+                context.user_data.pop('selected_topic_id', None)
                 context.user_data.pop('waiting_for', None)
                 
-                topic_name = user_topics[topic_index]['topic']
-                rep_date = user_topics[topic_index]['repetitions'][repetition_index]['date']
-                moscow_time = rep_date.astimezone(MOSCOW_TZ) if rep_date.tzinfo else rep_date
+                topic_name = topic_data.name
+                rep_ts = topic_data.rep_ts[repetition_index]
                 
-                await update.message.reply_text(
-                    f"✅ Повторение {repetition_index + 1} для '{topic_name}' выполнено!\nВремя: {moscow_time.strftime('%d.%m.%Y %H:%M')} МСК"
-                )
+                if already_done:
+                    await update.message.reply_text(
+                        f"Повторение {repetition_index + 1} для '{topic_name}' уже отмечено ✅\nВремя: {format_time(rep_ts)} МСК"
+                    )
+                else:
+                    await update.message.reply_text(
+                        f"✅ Повторение {repetition_index + 1} для '{topic_name}' выполнено!\nВремя: {format_time(rep_ts)} МСК"
+                    )
             else:
                 await update.message.reply_text("❌ Неверный номер повторения!")
                 
@@ -335,114 +778,353 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Введите число!")
     
     else:
-        await update.message.reply_text("🤔 Используйте команды: /start, /newtopic, /list, /done")
+        await update.message.reply_text("🤔 Используйте команды: /start, /newtopic, /list, /done, /today, /import, /export")
+
+def paginate(header, blocks):
+    """Раскладывает блоки текста по страницам не длиннее PAGE_CHAR_LIMIT"""
+    pages = []
+    page = header
+    count = 0
+    for block in blocks:
+        block = block[:PAGE_CHAR_LIMIT - len(header)]
+        if count and (count >= PAGE_SIZE or len(page) + len(block) > PAGE_CHAR_LIMIT):
+            pages.append(page)
+            page = header
+            count = 0
+        page += block
+        count += 1
+    pages.append(page)
+    return pages
+
+def render_list_block(topic_index, topic_data):
+    """Блок /list для одной темы"""
+    block = f"🎯 Тема {topic_index}: {topic_data.name}\n"
+    block += f"   Изучена: {format_time(topic_data.study_ts)} МСК\n"
+    block += "   Повторения:\n"
+    
+    completed_count = topic_data.completed_count()
+    total_count = len(topic_data)
+    
+    for rep_index, rep_ts in enumerate(topic_data.rep_ts):
+        status = "✅ Выполнено" if topic_data.is_done(rep_index) else "⏳ Ожидает"
+        block += f"   {rep_index + 1}. {format_time(rep_ts)} МСК - {status}\n"
+    
+    block += f"   Прогресс: {completed_count}/{total_count} выполнено\n\n"
+    return block
+
+def render_done_block(topic_index, topic_data):
+    """Строка /done для одной темы"""
+    return f"{topic_index}. {topic_data.name} ({topic_data.completed_count()}/{len(topic_data)} выполнено)\n"
+
+VIEWS = {
+    'list': ("📚 Ваши темы для повторения:\n\n", render_list_block),
+    'done': ("📋 Выберите тему для отметки (введите номер):\n\n", render_done_block),
+}
+
+def get_view(user_id, kind):
+    """Страницы вида kind для пользователя; пересчитываются только после изменений"""
+    views = view_cache.setdefault(user_id, {})
+    pages = views.get(kind)
+    if pages is None:
+        header, render_block = VIEWS[kind]
+        pages = paginate(header, (render_block(i, topic) for i, topic in enumerate(get_topics(user_id), 1)))
+        views[kind] = pages
+    return pages
+
+def invalidate_view(user_id):
+    """Сбрасывает кэш страниц пользователя после изменения его тем"""
+    view_cache.pop(user_id, None)
+
+def page_keyboard(kind, page, total):
+    """Кнопки переключения страниц; None, если страница одна"""
+    if total <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"{kind}:{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{total}", callback_data=f"{kind}:{page}"))
+    if page < total - 1:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"{kind}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
 
 async def list_topics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    if user_id not in user_data or not user_data[user_id]:
+    if not get_topics(user_id):
         await update.message.reply_text("📭 У вас пока нет добавленных тем.")
         return
     
-    response = "📚 Ваши темы для повторения:\n\n"
-    
-    for topic_index, topic_data in enumerate(user_data[user_id], 1):
-        response += f"🎯 Тема {topic_index}: {topic_data['topic']}\n"
-        study_date = topic_data['study_date']
-        moscow_study_time = study_date.astimezone(MOSCOW_TZ) if study_date.tzinfo else study_date
-        response += f"   Изучена: {moscow_study_time.strftime('%d.%m.%Y %H:%M')} МСК\n"
-        response += "   Повторения:\n"
-        
-        completed_count = sum(1 for rep in topic_data['repetitions'] if rep['completed'])
-        total_count = len(topic_data['repetitions'])
-        
-        for rep_index, repetition in enumerate(topic_data['repetitions'], 1):
-            status = "✅ Выполнено" if repetition['completed'] else "⏳ Ожидает"
-            rep_date = repetition['date']
-            moscow_rep_time = rep_date.astimezone(MOSCOW_TZ) if rep_date.tzinfo else rep_date
-            response += f"   {rep_index}. {moscow_rep_time.strftime('%d.%m.%Y %H:%M')} МСК - {status}\n"
-        
-        response += f"   Прогресс: {completed_count}/{total_count} выполнено\n\n"
-    
-    await update.message.reply_text(response)
+    pages = get_view(user_id, 'list')
+    await update.message.reply_text(pages[0], reply_markup=page_keyboard('list', 0, len(pages)))
 
 async def mark_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    if user_id not in user_data or not user_data[user_id]:
+    if not get_topics(user_id):
         await update.message.reply_text("❌ У вас нет тем для отметки.")
         return
     
-    response = "📋 Выберите тему для отметки (введите номер):\n\n"
-    for i, topic_data in enumerate(user_data[user_id], 1):
-        completed = sum(1 for rep in topic_data['repetitions'] if rep['completed'])
-        total = len(topic_data['repetitions'])
-        response += f"{i}. {topic_data['topic']} ({completed}/{total} выполнено)\n"
+    pages = get_view(user_id, 'done')
+    await update.message.reply_text(pages[0], reply_markup=page_keyboard('done', 0, len(pages)))
+    context.user_data['waiting_for'] = 'topic_choice'
+
+async def today(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Повторения со сроком до конца сегодняшнего дня, включая просроченные"""
+    user_id = update.effective_user.id
+    now = get_moscow_time()
+    end_of_day = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    
+    ensure_due_index(user_id)
+    items = []
+    for due_ts, topic_id, rep_index in due_index.due(user_id, end_of_day):
+        items.append((topic_id, find_topic(user_id, topic_id).name, due_ts, rep_index + 1))
+    upcoming = None
+    if not items:
+        entry = due_index.next_after(user_id, end_of_day)
+        if entry is not None:
+            due_ts, topic_id, rep_index = entry
+            upcoming = (topic_id, find_topic(user_id, topic_id).name, due_ts, rep_index + 1)
     
+    text, kwargs = render_today(items, now.timestamp(), upcoming)
+    await update.message.reply_text(text, **kwargs)
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "📥 Отправьте файл CSV или JSON со списком тем.\n\n"
+        "CSV: первая строка - заголовок topic,study_date, дальше по теме в строке:\n"
+        "Производные,01.09.2025 18:00\n\n"
+        "JSON: [{\"topic\": \"Производные\", \"study_date\": \"01.09.2025 18:00\"}]\n\n"
+        "Дата - по Москве, ДД.ММ.ГГГГ ЧЧ:ММ или ISO 8601.\n"
+        "Необязательная колонка completed - номера уже выполненных повторений через запятую."
+    )
+    context.user_data['waiting_for'] = 'import'
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Файл для /import: проверяется целиком и добавляется одной пачкой"""
+    caption = (update.message.caption or '').strip()
+    if context.user_data.get('waiting_for') != 'import' and not caption.startswith('/import'):
+        await update.message.reply_text("📎 Чтобы загрузить темы из файла, сначала отправьте /import")
+        return
+    
+    user_id = update.effective_user.id
+    document = update.message.document
+    try:
+        if document.file_size and document.file_size > MAX_BYTES:
+            raise TransferError([f"файл больше {MAX_BYTES // 1024} КБ"])
+        data = await (await document.get_file()).download_as_bytearray()
+        rows = parse_import(data, document.file_name or '')
+    except TransferError as e:
+        errors = e.errors[:MAX_ERRORS]
+        if len(e.errors) > MAX_ERRORS:
+            errors.append(f"...и ещё {len(e.errors) - MAX_ERRORS}")
+        await update.message.reply_text("❌ Темы не импортированы:\n" + "\n".join(errors) + "\n\nИсправьте файл и отправьте его снова.")
+        return
+    
+    added, skipped = import_topics(context.application, user_id, rows)
+    context.user_data.pop('waiting_for', None)
+    print(f"📥 Импорт: пользователь {user_id}, добавлено {added}, пропущено {skipped}")
+    response = f"✅ Импортировано тем: {added}"
+    if skipped:
+        response += f"\n↩️ Уже были добавлены раньше: {skipped}"
+    response += "\n🔔 Напоминания запланированы автоматически!"
     await update.message.reply_text(response)
-    context.user_data['waiting_for'] = 'topic_choice'
+
+async def export_topics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    topics = get_topics(user_id)
+    if not topics:
+        await update.message.reply_text("📭 У вас пока нет добавленных тем.")
+        return
+    
+    if context.args and context.args[0].lower() == 'json':
+        data, filename = export_json(topics), 'topics.json'
+    else:
+        data, filename = export_csv(topics), 'topics.csv'
+    await update.message.reply_document(
+        document=io.BytesIO(data),
+        filename=filename,
+        caption=f"📤 Темы: {len(topics)}. Этот файл можно загрузить обратно через /import"
+    )
+
+async def handle_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переключение страницы /list или /done"""
+    query = update.callback_query
+    kind, page = query.data.split(':')
+    pages = get_view(update.effective_user.id, kind)
+    page = min(int(page), len(pages) - 1)
+    
+    await query.answer()
+    try:
+        await query.edit_message_text(pages[page], reply_markup=page_keyboard(kind, page, len(pages)))
+    except BadRequest as e:
+        # Повторное нажатие на текущую страницу
+        if 'not modified' not in str(e):
+            raise
+
+async def handle_done_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка «✅ Готово» под напоминанием: отметка повторения в одно нажатие"""
+    query = update.callback_query
+    _, topic_id, rep_index, *grade = query.data.split(':')
+    topic_id, rep_index = int(topic_id), int(rep_index)
+    grade = grade[0] if grade else None
+    user_id = update.effective_user.id
+    topic = find_topic(user_id, topic_id)
+    
+    if topic is None or not 0 <= rep_index < len(topic):
+        await query.answer("❌ Тема не найдена")
+        return
+    if topic.is_done(rep_index):
+        await query.answer("Уже отмечено ✅")
+    else:
+        complete_repetition(context.application, user_id, topic, rep_index, grade)
+        # Ответ на нажатие Telegram ограничивает 200 символами
+        await query.answer(f"✅ Повторение {rep_index + 1} для '{shorten(topic.name, 100)}' выполнено!")
+    
+    # Убираем нажатую кнопку из напоминания
+    keyboard = query.message.reply_markup.inline_keyboard if query.message and query.message.reply_markup else ()
+    rows = [row for row in keyboard if not any(button.callback_data == query.data for button in row)]
+    try:
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(rows) if rows else None)
+    except BadRequest as e:
+        if 'not modified' not in str(e):
+            raise
 
 async def handle_unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
-        "❌ Используйте /start, /newtopic, /list или /done"
+        "❌ Используйте /start, /newtopic, /list, /done, /today, /import или /export"
+    )
+
+def build_application(token):
+    """Создает Application с обработчиками"""
+    builder = Application.builder().token(token).post_init(on_startup).post_stop(on_stop)
+    # Незавершённые диалоги (/newtopic, /done) переживают перезапуск
+    builder = builder.persistence(DialogPersistence(get_storage(), SHARD))
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+    application = builder.build()
+    
+    # Добавляем обработчики
+    application.add_handler(CommandHandler("start", instrumented(start)))
+    application.add_handler(CommandHandler("newtopic", instrumented(new_topic)))
+    application.add_handler(CommandHandler("list", instrumented(list_topics)))
+    application.add_handler(CommandHandler("done", instrumented(mark_done)))
+    application.add_handler(CommandHandler("today", instrumented(today)))
+    application.add_handler(CommandHandler("import", instrumented(import_command)))
+    application.add_handler(CommandHandler("export", instrumented(export_topics)))
+    application.add_handler(MessageHandler(filters.Document.ALL, instrumented(handle_document)))
+    application.add_handler(CallbackQueryHandler(instrumented(handle_page), pattern=r'^(list|done):\d+$'))
+    application.add_handler(CallbackQueryHandler(instrumented(handle_done_button), pattern=r'^rep:\d+:\d+(:(hard|easy))?$'))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(handle_text_input)))
+    application.add_handler(MessageHandler(filters.COMMAND, instrumented(handle_unknown)))
+    return application
+
+async def run_webhook(application, register=True):
+    """Работа в режиме webhook: обновления приходят через Flask-эндпоинт /telegram
+
+    register=False - режим воркера шарда: webhook у Telegram регистрирует
+    диспетчер, он же пересылает сюда обновления.
+    """
+    global bot_application, bot_loop, update_mode
+    
+    update_mode = 'webhook' if register else 'worker'
+    await application.initialize()
+    try:
+        if register:
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}/telegram",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True
+            )
+        await application.post_init(application)
+        await application.start()
+        if register:
+            print(f"🌐 Webhook установлен: {WEBHOOK_URL}")
+        else:
+            print(f"🧩 Воркер шарда {SHARD_INDEX}/{SHARD_COUNT} принимает обновления на порту {PORT}")
+        
+        # SIGTERM (остановка контейнера, supervisor) - штатное завершение с досохранением
+        stopped = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+        except NotImplementedError:  # Windows
+            pass
+        await stopped.wait()
+    finally:
+        bot_application = None
+        bot_loop = None
+        if application.running:
+            await application.stop()
+            await application.post_stop(application)
+        await application.shutdown()
+
+def run_polling(application):
+    """Работа через long polling"""
+    global update_mode
+    update_mode = 'polling'
+    application.run_polling(
+        drop_pending_updates=True,
+        allowed_updates=Update.ALL_TYPES,
+        # Пауза после каждого getUpdates ограничивала приём ~100 обновлениями
+        # в секунду; ожидание новых обновлений и так даёт long polling (timeout)
+        poll_interval=0,
+        timeout=10,
+        close_loop=False
     )
 
 def main():
     """Основная функция запуска бота"""
     load_data()
+    atexit.register(flush_on_exit)
     
     TOKEN = os.getenv('BOT_TOKEN')
     if not TOKEN:
         print("❌ Токен бота не найден!")
         return
     
-    application = Application.builder().token(TOKEN).build()
-    
-    # Добавляем обработчики
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("newtopic", new_topic))
-    application.add_handler(CommandHandler("list", list_topics))
-    application.add_handler(CommandHandler("done", mark_done))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_input))
-    application.add_handler(MessageHandler(filters.COMMAND, handle_unknown))
+    application = build_application(TOKEN)
     
-    print("🚀 Запускаем Flask сервер для порта 5000...")
+    print(f"🚀 Запускаем Flask сервер для порта {PORT}...")
     
     # Запускаем Flask в отдельном потоке
     flask_thread = threading.Thread(target=run_flask)
     flask_thread.daemon = True
     flask_thread.start()
     
-    # Запускаем планировщик напоминаний
-    schedule_reminders(application)
+    use_webhook = bool(WEBHOOK_URL)
+    if use_webhook and not WEBHOOK_SECRET:
+        print("⚠️ WEBHOOK_SECRET не задан, используем polling")
+        use_webhook = False
+    
+    if SHARD and (STORAGE_BACKEND != 'sqlite' or not WEBHOOK_SECRET):
+        print("❌ Воркеру шарда нужны STORAGE_BACKEND=sqlite и WEBHOOK_SECRET")
+        return
     
     print("🤖 Запускаем Telegram бота...")
     
     # Улучшенный запуск с автоматическим восстановлением
     while True:
         try:
-            application.run_polling(
-                drop_pending_updates=True,
-                allowed_updates=Update.ALL_TYPES,
-                poll_interval=1,
-                timeout=10,
-                close_loop=False
-            )
+            if SHARD:
+                asyncio.run(run_webhook(application, register=False))
+            elif use_webhook:
+                asyncio.run(run_webhook(application))
+            else:
+                run_polling(application)
+            print("🛑 Бот остановлен")
+            break
+        except KeyboardInterrupt:
+            break
         except Exception as e:
             print(f"❌ Ошибка бота: {e}")
+            if use_webhook and not SHARD:
+                # Если webhook не поднялся, продолжаем через polling
+                print("🔁 Переключаемся на polling")
+                use_webhook = False
             print("🔄 Перезапускаем бота через 30 секунд...")
             time.sleep(30)
             # Пересоздаем application для чистого перезапуска
-            application = Application.builder().token(TOKEN).build()
-            # Пере добавляем обработчики
-            application.add_handler(CommandHandler("start", start))
-            application.add_handler(CommandHandler("newtopic", new_topic))
-            application.add_handler(CommandHandler("list", list_topics))
-            application.add_handler(CommandHandler("done", mark_done))
-            application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_input))
-            application.add_handler(MessageHandler(filters.COMMAND, handle_unknown))
-            # Перезапускаем планировщик
-            schedule_reminders(application)
+            application = build_application(TOKEN)
 
 if __name__ == '__main__':
     main()
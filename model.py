@@ -0,0 +1,119 @@
+"""Компактная модель тем и повторений
+
+Тема хранит время изучения и сроки повторений как целые секунды epoch
+(array('q') без отдельного объекта на каждое число), а отметки о
+выполнении и об отправленных напоминаниях - битовыми масками. У
+выполненного повторения в rep_ts записано фактическое время выполнения
+(в старых записях - плановый срок). Объекты datetime создаются только
+при выводе.
+"""
+from array import array
+from datetime import datetime
+
+import pytz
+
+# Московский часовой пояс
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+# Начальный коэффициент лёгкости темы (см. srs.py)
+DEFAULT_EASE = 2.5
+
+
+def to_moscow(dt):
+    """Приводит datetime к московскому поясу (наивные считаются московскими)"""
+    return MOSCOW_TZ.localize(dt) if dt.tzinfo is None else dt.astimezone(MOSCOW_TZ)
+
+
+def from_timestamp(ts):
+    return datetime.fromtimestamp(ts, MOSCOW_TZ)
+
+
+class Topic:
+    """Тема с расписанием повторений
+
+    id - постоянный номер темы внутри пользователя, не зависит от её
+    позиции в списке.
+    """
+
+    __slots__ = ('id', 'name', 'study_ts', 'rep_ts', 'done_mask', 'sent_mask', 'ease')
+
+    def __init__(self, topic_id, name, study_ts, rep_ts, done_mask=0, sent_mask=0, ease=DEFAULT_EASE):
+        self.id = topic_id
+        self.name = name
+        self.study_ts = study_ts
+        self.rep_ts = rep_ts if isinstance(rep_ts, array) else array('q', rep_ts)
+        self.done_mask = done_mask
+        self.sent_mask = sent_mask
+        self.ease = ease
+
+    @classmethod
+    def create(cls, topic_id, name, study_date, intervals):
+        """Новая тема: повторения через заданные интервалы от study_date"""
+        study_ts = int(study_date.timestamp())
+        return cls(topic_id, name, study_ts, [study_ts + int(interval.total_seconds()) for interval in intervals])
+
+    @property
+    def study_date(self):
+        return from_timestamp(self.study_ts)
+
+    def __len__(self):
+        return len(self.rep_ts)
+
+    def rep_date(self, index):
+        return from_timestamp(self.rep_ts[index])
+
+    def is_done(self, index):
+        return bool(self.done_mask >> index & 1)
+
+    def mark_done(self, index):
+        self.done_mask |= 1 << index
+
+    def reschedule(self, index, ts):
+        """Переносит срок повторения; напоминание о нём будет отправлено заново"""
+        self.rep_ts[index] = ts
+        self.sent_mask &= ~(1 << index)
+
+    def is_notified(self, index):
+        """Напоминание об этом повторении уже отправлено"""
+        return bool(self.sent_mask >> index & 1)
+
+    def mark_notified(self, index):
+        self.sent_mask |= 1 << index
+
+    def completed_count(self):
+        return bin(self.done_mask).count('1')
+
+    def pending(self):
+        """Индексы и сроки невыполненных повторений"""
+        return [(index, ts) for index, ts in enumerate(self.rep_ts) if not self.done_mask >> index & 1]
+
+    def to_record(self):
+        """JSON-совместимая запись для хранилища"""
+        return {
+            'id': self.id, 'name': self.name, 'study': self.study_ts,
+            'reps': list(self.rep_ts), 'done': self.done_mask, 'sent': self.sent_mask, 'ease': self.ease,
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        """Тема из записи хранилища; понимает и старый формат user_data.json"""
+        topic_id = record['id']
+        if 'reps' in record:
+            return cls(
+                topic_id, record['name'], record['study'], record['reps'], record['done'],
+                record.get('sent', 0), record.get('ease', DEFAULT_EASE)
+            )
+
+        def parse(value):
+            return int(to_moscow(datetime.fromisoformat(value)).timestamp())
+
+        done_mask = 0
+        for index, rep in enumerate(record['repetitions']):
+            if rep['completed']:
+                done_mask |= 1 << index
+        return cls(
+            topic_id,
+            record['topic'],
+            parse(record['study_date']),
+            [parse(rep['date']) for rep in record['repetitions']],
+            done_mask
+        )
@@ -0,0 +1,219 @@
+"""Отложенная (write-behind) запись тем в хранилище
+
+Обработчики не пишут в базу сами: они отдают снимок изменённой темы в
+WriteBehind.mark(). Снимки копятся в словаре по ключу (user_id, id темы),
+так что несколько изменений одной темы схлопываются в одну запись. Фоновая
+задача раз в interval секунд (или сразу, когда накопилось batch_size тем)
+записывает пачку одной транзакцией в отдельном потоке и не блокирует
+event loop.
+
+Снимок - это готовая запись Topic.to_record(), снятая на event loop в
+момент изменения, поэтому поток записи никогда не видит тему в
+промежуточном состоянии.
+
+DialogPersistence - то же для состояния диалогов (context.user_data):
+python-telegram-bot раз в update_interval секунд отдаёт состояния
+пользователей, писавших боту, и они записываются одной транзакцией.
+"""
+import asyncio
+import os
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', '1.0'))
+FLUSH_BATCH = int(os.getenv('FLUSH_BATCH', '500'))
+DIALOG_FLUSH_INTERVAL = float(os.getenv('DIALOG_FLUSH_INTERVAL', '5'))
+
+
+class WriteBehind:
+    def __init__(self, storage, interval=FLUSH_INTERVAL, batch_size=FLUSH_BATCH):
+        self.storage = storage
+        self.interval = interval
+        self.batch_size = batch_size
+        self._dirty = {}
+        self._task = None
+        self._wakeup = None
+        self._stopping = False
+        self._flush_lock = None
+
+    def __len__(self):
+        return len(self._dirty)
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def mark(self, user_id, record):
+        """Запоминает снимок темы для следующей записи"""
+        self._dirty[(user_id, record['id'])] = record
+        if self._wakeup is not None and len(self._dirty) >= self.batch_size:
+            self._wakeup.set()
+
+    def request_flush(self):
+        """Просит фоновую задачу записать накопленное, не дожидаясь интервала"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _take_batch(self):
+        batch, self._dirty = self._dirty, {}
+        return batch
+
+    def _restore(self, batch):
+        # Более новые снимки, появившиеся во время записи, важнее
+        for key, record in batch.items():
+            self._dirty.setdefault(key, record)
+
+    async def flush(self):
+        """Записывает накопленное; при ошибке пачка вернётся в очередь"""
+        async with self._flush_lock:
+            batch = self._take_batch()
+            if not batch:
+                return 0
+            try:
+                await asyncio.to_thread(self.storage.save_topics, [(user_id, record) for (user_id, _), record in batch.items()])
+            except Exception as e:
+                self._restore(batch)
+                print(f"❌ Ошибка при сохранении {len(batch)} тем: {e}")
+                return 0
+            return len(batch)
+
+    def flush_sync(self):
+        """Синхронная запись накопленного, когда event loop не работает"""
+        batch = self._take_batch()
+        if batch:
+            self.storage.save_topics([(user_id, record) for (user_id, _), record in batch.items()])
+        return len(batch)
+
+    def start(self):
+        if self.running:
+            return
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую запись и гарантированно сохраняет остаток"""
+        if self._task is not None:
+            # Флаг страхует от потерянной отмены в wait_for (Python < 3.12)
+            self._stopping = True
+            self._wakeup.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self.flush()
+        self._wakeup = None
+        if self._dirty:
+            print(f"💾 Сохранено {self.flush_sync()} тем при остановке")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # shield: отмена при остановке не должна прерывать начатую запись
+            await asyncio.shield(self.flush())
+
+
+class DialogPersistence(BasePersistence):
+    """Состояние диалогов в хранилище бота, чтобы перезапуск не обрывал /newtopic и /done
+
+    Хранится только user_data. Application помечает пользователя при каждом
+    его обновлении, поэтому неизменившиеся состояния отсеиваются здесь и в
+    базу не пишутся; пустое состояние удаляет запись.
+    """
+
+    def __init__(self, storage, shard=None, update_interval=DIALOG_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.storage = storage
+        self.shard = shard
+        self._saved = {}
+        self._pending = {}
+        self._lock = asyncio.Lock()
+
+    async def get_user_data(self):
+        self._saved = await asyncio.to_thread(self.storage.load_dialogs, self.shard)
+        if self._saved:
+            print(f"💬 Восстановлено незавершённых диалогов: {len(self._saved)}")
+        return {user_id: dict(state) for user_id, state in self._saved.items()}
+
+    async def update_user_data(self, user_id, data):
+        if data == self._pending.get(user_id, self._saved.get(user_id, {})):
+            return
+        self._pending[user_id] = data
+        await self._write()
+
+    async def drop_user_data(self, user_id):
+        self._pending[user_id] = {}
+        await self._write()
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def flush(self):
+        await self._write()
+
+    async def _write(self):
+        # Application вызывает update_user_data для всех пользователей разом
+        # через gather: даём остальным вызовам добавить свои состояния, и
+        # первый из них пишет всю пачку
+        await asyncio.sleep(0)
+        async with self._lock:
+            batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                await asyncio.to_thread(self.storage.save_dialogs, batch)
+            except Exception as e:
+                for user_id, state in batch.items():
+                    self._pending.setdefault(user_id, state)
+                print(f"❌ Ошибка при сохранении {len(batch)} диалогов: {e}")
+                return
+            for user_id, state in batch.items():
+                if state:
+                    self._saved[user_id] = state
+                else:
+                    self._saved.pop(user_id, None)
+
+    # Остальные данные бот не хранит
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,157 @@
+"""Диспетчер напоминаний на event loop приложения
+
+Вместо отдельной задачи APScheduler на каждое повторение все сроки лежат в
+одной куче. Диспетчер - одна asyncio-задача, которая спит до ближайшего
+срока и просыпается раньше только если добавлен более ранний элемент.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+
+# Верхняя граница сна: страхует от перевода системных часов
+MAX_SLEEP = 60
+
+# Индексы полей записи в куче
+_DUE, _SEQ, _KEY, _PAYLOAD, _ACTIVE = range(5)
+
+
+class ReminderQueue:
+    """Очередь отложенных вызовов, упорядоченная по времени срабатывания
+
+    Вставка - O(log n). Отмена по ключу помечает запись неактивной за O(1),
+    а устаревшие элементы выбрасываются из кучи при извлечении; если
+    отменённых становится больше половины, куча перестраивается.
+
+    callback(key, due_ts, payload) - корутина, вызывается для каждого
+    наступившего элемента.
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+        self._inflight = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def push(self, key, due_ts, payload=None):
+        """Добавляет или переносит элемент с ключом key"""
+        self.cancel(key)
+        entry = [due_ts, next(self._counter), key, payload, True]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._wake()
+
+    def extend(self, items):
+        """Добавляет много элементов (key, due_ts, payload)
+
+        Большая пачка вставляется с перестройкой кучи за O(n), маленькая
+        относительно кучи (импорт нескольких тем) - по одному за O(k log n),
+        чтобы не перебирать всю кучу на event loop.
+        """
+        entries = []
+        for key, due_ts, payload in items:
+            self.cancel(key)
+            entry = [due_ts, next(self._counter), key, payload, True]
+            self._entries[key] = entry
+            entries.append(entry)
+        if len(entries) * max(len(self._heap), 1).bit_length() < len(self._heap) + len(entries):
+            for entry in entries:
+                heapq.heappush(self._heap, entry)
+        else:
+            self._heap.extend(entries)
+            heapq.heapify(self._heap)
+        self._wake()
+
+    def cancel(self, key):
+        """Отменяет элемент; возвращает True, если он был в очереди"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[_ACTIVE] = False
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [e for e in self._heap if e[_ACTIVE]]
+            heapq.heapify(self._heap)
+        return True
+
+    def clear(self):
+        self._heap.clear()
+        self._entries.clear()
+
+    def next_due(self):
+        """Время ближайшего активного элемента или None"""
+        while self._heap and not self._heap[0][_ACTIVE]:
+            heapq.heappop(self._heap)
+        return self._heap[0][_DUE] if self._heap else None
+
+    def pop_due(self, now):
+        """Извлекает все элементы со сроком <= now"""
+        due = []
+        while self._heap and self._heap[0][_DUE] <= now:
+            entry = heapq.heappop(self._heap)
+            if entry[_ACTIVE]:
+                del self._entries[entry[_KEY]]
+                due.append((entry[_KEY], entry[_DUE], entry[_PAYLOAD]))
+        return due
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Запускает диспетчер на текущем event loop"""
+        if self.running:
+            return
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # В Python < 3.12 wait_for теряет отмену, если событие выставлено
+        # в тот же момент, поэтому цикл проверяет ещё и флаг остановки
+        self._stopping = True
+        self._wake()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._wakeup = None
+
+    async def _run(self):
+        while not self._stopping:
+            for key, due_ts, payload in self.pop_due(time.time()):
+                task = asyncio.create_task(self._fire(key, due_ts, payload))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+
+            next_due = self.next_due()
+            delay = MAX_SLEEP if next_due is None else min(max(next_due - time.time(), 0), MAX_SLEEP)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, key, due_ts, payload):
+        try:
+            await self._callback(key, due_ts, payload)
+        except Exception as e:
+            print(f"❌ Ошибка обработки напоминания {key}: {e}")
@@ -0,0 +1,357 @@
+"""Горизонтальное масштабирование: воркеры по шардам пользователей
+
+Пользователи делятся на SHARD_COUNT шардов по user_id % SHARD_COUNT.
+Каждый шард обслуживает отдельный процесс main.py (воркер) с
+SHARD_INDEX = номер шарда: он загружает темы и планирует напоминания
+только своих пользователей и принимает обновления на POST /telegram.
+Все воркеры работают с одной базой SQLite.
+
+Обновления от Telegram получает один диспетчер и пересылает их воркеру
+шарда, сохраняя порядок обновлений каждого пользователя:
+
+    python sharding.py dispatcher      - getUpdates или webhook (WEBHOOK_URL),
+                                         адреса воркеров в WORKER_URLS
+    python sharding.py local -n 4      - локальный запуск: 4 воркера и
+                                         диспетчер в одном терминале
+
+Чтобы два процесса не отправили одно напоминание дважды (например, если
+старый воркер ещё не завершился, а новый уже запущен), воркер держит
+аренду своего шарда в базе и продлевает её; без действующей аренды
+напоминания не отправляются. Воркер не стартует, пока живы аренды с
+другим SHARD_COUNT: при смене числа шардов старые воркеры должны
+завершиться.
+"""
+import argparse
+import asyncio
+import hmac
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import httpx
+from flask import Flask, request
+
+LEASE_TTL = 30         # секунд; аренда продлевается каждые LEASE_TTL / 3
+FORWARD_TIMEOUT = 10
+MAX_BACKOFF = 30
+MAX_PENDING = 10000    # обновлений в очереди одного шарда, дальше polling ждёт
+DEFAULT_API_URL = 'https://api.telegram.org/bot'
+
+
+def shard_of(user_id, count):
+    return user_id % count
+
+
+def update_user_id(payload):
+    """Пользователь, от которого пришло обновление, или None"""
+    for value in payload.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('user')
+            if isinstance(sender, dict) and 'id' in sender:
+                return sender['id']
+            chat = value.get('chat')
+            if isinstance(chat, dict) and 'id' in chat:
+                return chat['id']
+    return None
+
+
+def route(payload, count):
+    """Номер шарда для обновления; обновления без пользователя - в шард 0"""
+    user_id = update_user_id(payload)
+    return 0 if user_id is None else shard_of(user_id, count)
+
+
+class ShardLease:
+    """Аренда шарда в общей базе
+
+    start() ждёт, пока аренда освободится, и затем продлевает её в фоне.
+    held - аренда действует; проверяется перед каждой отправкой
+    напоминания.
+    """
+
+    def __init__(self, storage, count, index, ttl=LEASE_TTL):
+        self.storage = storage
+        self.count = count
+        self.name = f"shard:{count}:{index}"
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.ttl = ttl
+        self._expires = 0
+        self._task = None
+
+    @property
+    def held(self):
+        return time.time() < self._expires
+
+    async def _conflicts(self):
+        """Живые аренды воркеров с другим числом шардов"""
+        leases = await asyncio.to_thread(self.storage.active_leases, 'shard:')
+        return [name for name in leases if not name.startswith(f"shard:{self.count}:")]
+
+    async def _acquire(self):
+        started = time.time()
+        if await asyncio.to_thread(self.storage.acquire_lease, self.name, self.owner, self.ttl):
+            # Считаем от момента запроса: так аренда не переживёт себя в базе
+            self._expires = started + self.ttl
+            return True
+        self._expires = 0
+        return False
+
+    async def start(self):
+        while True:
+            conflicts = await self._conflicts()
+            if conflicts:
+                print(f"⏳ Работают воркеры с другим числом шардов ({', '.join(conflicts)}), ждём их завершения")
+            elif await self._acquire():
+                break
+            else:
+                print(f"⏳ Шард {self.name} занят другим процессом, ждём освобождения аренды")
+            await asyncio.sleep(self.ttl / 3)
+        print(f"🔑 Аренда {self.name} получена ({self.owner})")
+        self._task = asyncio.get_running_loop().create_task(self._renew())
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if not await self._acquire():
+                    print(f"❌ Аренда {self.name} потеряна, напоминания приостановлены")
+            except Exception as e:
+                print(f"❌ Ошибка продления аренды {self.name}: {e}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._expires = 0
+        await asyncio.to_thread(self.storage.release_lease, self.name, self.owner)
+
+
+class Dispatcher:
+    """Пересылка обновлений воркерам шардов
+
+    У каждого шарда своя очередь: его обновления отправляются строго по
+    порядку, разные шарды - независимо друг от друга. Недоступный воркер
+    получает обновление повторно с нарастающей паузой и задерживает только
+    свой шард: ничего не теряется, пока диспетчер работает.
+    """
+
+    def __init__(self, worker_urls, secret, max_pending=MAX_PENDING):
+        self.worker_urls = worker_urls
+        self.secret = secret
+        self.max_pending = max_pending
+        # Следующее недоставленное обновление и число ждущих доставки по шардам
+        self.offsets = [None] * len(worker_urls)
+        self.pending = [0] * len(worker_urls)
+
+    def shard(self, payload):
+        return route(payload, len(self.worker_urls))
+
+    def target(self, payload):
+        return self.worker_urls[self.shard(payload)]
+
+    async def forward(self, client, payload):
+        """Доставляет обновление воркеру; возвращает HTTP-код ответа"""
+        url = self.target(payload)
+        delay = 1
+        while True:
+            try:
+                response = await client.post(url, json=payload, headers={'X-Telegram-Bot-Api-Secret-Token': self.secret})
+                if response.status_code < 500:
+                    if response.status_code != 200:
+                        print(f"❌ Воркер {url} отклонил обновление {payload.get('update_id')}: HTTP {response.status_code}")
+                    return response.status_code
+                reason = f"HTTP {response.status_code}"
+            except httpx.HTTPError as e:
+                reason = str(e) or type(e).__name__
+            print(f"⚠️ Воркер {url} недоступен ({reason}), повтор через {delay} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
+
+    async def forward_shard(self, client, index, queue):
+        """Пересылает обновления шарда index из его очереди по порядку"""
+        while True:
+            payload = await queue.get()
+            try:
+                await self.forward(client, payload)
+                self.offsets[index] = payload['update_id'] + 1
+                self.pending[index] -= 1
+            finally:
+                queue.task_done()
+
+    async def run_polling(self, token, api_url=DEFAULT_API_URL):
+        """Единственный getUpdates на всех воркеров
+
+        Полученная пачка раскладывается по очередям шардов, и смещение
+        getUpdates сразу сдвигается дальше: недоступный воркер копит
+        обновления в своей очереди, не останавливая остальные шарды. Когда
+        в очереди шарда набирается max_pending обновлений, приём ждёт, пока
+        она не освободится. Недоставленные обновления хранятся только в
+        памяти диспетчера; при остановке их число выводится в лог.
+        """
+        api = f"{api_url}{token}"
+        offset = None
+        queues = [asyncio.Queue(self.max_pending) for _ in self.worker_urls]
+        async with httpx.AsyncClient(timeout=FORWARD_TIMEOUT) as workers, \
+                httpx.AsyncClient(timeout=FORWARD_TIMEOUT + 30) as telegram:
+            tasks = [
+                asyncio.create_task(self.forward_shard(workers, index, queue))
+                for index, queue in enumerate(queues)
+            ]
+            try:
+                await telegram.post(f"{api}/deleteWebhook")
+                print(f"📡 Диспетчер: polling, воркеров {len(self.worker_urls)}")
+                while True:
+                    try:
+                        response = await telegram.post(f"{api}/getUpdates", json={'offset': offset, 'timeout': 25})
+                        updates = response.json().get('result') or []
+                    except (httpx.HTTPError, ValueError) as e:
+                        print(f"⚠️ Ошибка getUpdates: {e}")
+                        await asyncio.sleep(1)
+                        continue
+                    for payload in updates:
+                        index = self.shard(payload)
+                        await queues[index].put(payload)
+                        self.pending[index] += 1
+                    if updates:
+                        offset = updates[-1]['update_id'] + 1
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                for index, count in enumerate(self.pending):
+                    if count:
+                        print(f"⚠️ Шард {index}: не доставлено {count} обновлений ({self.worker_urls[index]})")
+
+    def webhook_app(self):
+        """Flask-приложение, принимающее webhook Telegram и пересылающее воркеру"""
+        app = Flask(__name__)
+        client = httpx.Client(timeout=FORWARD_TIMEOUT)
+
+        @app.route('/telegram', methods=['POST'])
+        def telegram_webhook():
+            secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(secret, self.secret):
+                return "forbidden", 403
+            payload = request.get_json(force=True, silent=True)
+            if not isinstance(payload, dict):
+                return "bad request", 400
+            # Ответ воркера возвращается Telegram: при ошибке он повторит доставку
+            try:
+                response = client.post(self.target(payload), json=payload,
+                                       headers={'X-Telegram-Bot-Api-Secret-Token': self.secret})
+            except httpx.HTTPError:
+                return "worker unavailable", 502
+            return response.text, response.status_code
+
+        @app.route('/ping')
+        def ping():
+            return "pong", 200
+
+        return app
+
+
+def run_dispatcher(worker_urls, port):
+    """Диспетчер по переменным окружения: webhook при WEBHOOK_URL, иначе polling"""
+    token = os.getenv('BOT_TOKEN')
+    secret = os.getenv('WEBHOOK_SECRET')
+    if not token or not secret:
+        print("❌ Для диспетчера нужны BOT_TOKEN и WEBHOOK_SECRET")
+        sys.exit(1)
+    api_url = os.getenv('BOT_API_URL') or DEFAULT_API_URL
+    dispatcher = Dispatcher(worker_urls, secret)
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if not webhook_url:
+        asyncio.run(dispatcher.run_polling(token, api_url))
+        return
+    httpx.post(f"{api_url}{token}/setWebhook", json={
+        'url': f"{webhook_url.rstrip('/')}/telegram",
+        'secret_token': secret,
+        'drop_pending_updates': True,
+    }, timeout=FORWARD_TIMEOUT).raise_for_status()
+    print(f"🌐 Диспетчер: webhook {webhook_url}, воркеров {len(worker_urls)}")
+    dispatcher.webhook_app().run(host='0.0.0.0', port=port, threaded=True)
+
+
+def run_local(count, base_port, dispatch_port):
+    """Локальный запуск: count воркеров main.py и диспетчер в этом процессе"""
+    from storage import open_storage
+
+    env = dict(os.environ)
+    env.setdefault('WEBHOOK_SECRET', secrets.token_hex(16))
+    os.environ['WEBHOOK_SECRET'] = env['WEBHOOK_SECRET']
+    env['STORAGE_BACKEND'] = 'sqlite'
+    env.pop('WEBHOOK_URL', None)  # Воркеры не регистрируют webhook сами
+
+    # Миграции и перенос user_data.json - один раз, до запуска воркеров
+    root = os.path.dirname(os.path.abspath(__file__))
+    open_storage('sqlite', env.get('DB_FILE', 'user_data.db'), 'user_data.json').close()
+
+    workers = []
+    urls = []
+    for index in range(count):
+        port = base_port + index
+        worker_env = dict(env, SHARD_COUNT=str(count), SHARD_INDEX=str(index), PORT=str(port))
+        # Своя сессия: Ctrl+C из терминала получает только этот процесс, а
+        # воркерам останавливаться сигналом ниже, ровно один раз
+        workers.append(subprocess.Popen([sys.executable, os.path.join(root, 'main.py')], env=worker_env, start_new_session=True))
+        urls.append(f"http://127.0.0.1:{port}/telegram")
+    print(f"🚀 Запущено воркеров: {count}, порты {base_port}-{base_port + count - 1}")
+
+    def watch():
+        while True:
+            for index, worker in enumerate(workers):
+                if worker.poll() is not None:
+                    print(f"❌ Воркер шарда {index} завершился с кодом {worker.returncode}")
+                    return
+            time.sleep(1)
+
+    threading.Thread(target=watch, daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        run_dispatcher(urls, dispatch_port)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Штатная остановка: воркеры досохраняют данные и снимают аренды
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGTERM)
+        for worker in workers:
+            try:
+                worker.wait(timeout=LEASE_TTL)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    dispatcher = commands.add_parser('dispatcher', help="пересылка обновлений воркерам из WORKER_URLS")
+    dispatcher.add_argument('--port', type=int, default=int(os.getenv('PORT', '5000')))
+    local = commands.add_parser('local', help="воркеры и диспетчер на этой машине")
+    local.add_argument('-n', '--workers', type=int, default=2)
+    local.add_argument('--base-port', type=int, default=5101)
+    local.add_argument('--port', type=int, default=int(os.getenv('PORT', '5000')))
+    args = parser.parse_args()
+
+    if args.command == 'local':
+        run_local(args.workers, args.base_port, args.port)
+    else:
+        urls = [url.strip() for url in os.getenv('WORKER_URLS', '').split(',') if url.strip()]
+        if not urls:
+            print("❌ WORKER_URLS не задан: адреса воркеров через запятую, по порядку номеров шардов")
+            sys.exit(1)
+        run_dispatcher(urls, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Алгоритмы интервальных повторений
+
+Алгоритм решает, когда наступят следующие повторения темы после того, как
+пользователь выполнил очередное. Сроки всегда считаются по одной формуле:
+
+    срок[j] = опора + (смещение[j] - смещение[последнее]) * множитель
+
+где смещение[j] - сдвиг повторения j от даты изучения по INTERVALS,
+последнее - номер последнего выполненного повторения, опора - время его
+фактического выполнения (или дата изучения, если выполненных нет).
+
+FixedIntervals - прежнее поведение: опора всегда дата изучения, множитель 1,
+поздно выполненное повторение ничего не сдвигает.
+
+SM2 - вариант SuperMemo-2: следующие повторения отсчитываются от момента
+выполнения, а промежутки растягиваются или сжимаются по коэффициенту
+лёгкости темы, который меняется от оценки (hard/good/easy).
+
+plan_batch() пересчитывает сроки сразу для всех тем, например после смены
+алгоритма или INTERVALS. Если установлен numpy, расчёт идёт матрицами по
+группам тем с одинаковым числом повторений, иначе - циклом по темам.
+"""
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # Пакетный пересчёт работает и без numpy, только медленнее
+    np = None
+
+from model import DEFAULT_EASE
+
+MIN_EASE = 1.3
+# Оценки как в SM-2: 3 - вспомнил с трудом, 4 - нормально, 5 - легко
+GRADES = {'hard': 3, 'good': 4, 'easy': 5}
+
+
+class FixedIntervals:
+    """Сроки от даты изучения по фиксированным интервалам"""
+
+    name = 'fixed'
+    adaptive = False
+
+    def __init__(self, intervals):
+        self.offsets = [int(interval.total_seconds()) for interval in intervals]
+
+    def update_ease(self, ease, grade):
+        return ease
+
+    def factor(self, ease):
+        return 1.0
+
+    def anchor(self, topic):
+        """(опорное время, номер последнего выполненного повторения или -1)"""
+        return topic.study_ts, -1
+
+    def complete(self, topic, index, completed_ts, grade=None):
+        """Отмечает повторение выполненным; возвращает номера перенесённых повторений"""
+        topic.mark_done(index)
+        topic.rep_ts[index] = int(completed_ts)
+        topic.ease = self.update_ease(topic.ease, grade)
+        return self.plan(topic)
+
+    def plan(self, topic):
+        """Пересчитывает сроки невыполненных повторений после последнего выполненного"""
+        anchor_ts, last = self.anchor(topic)
+        factor = self.factor(topic.ease)
+        base = self.offsets[last] if last >= 0 else 0
+        changed = []
+        for index, due_ts in topic.pending():
+            if index <= last or index >= len(self.offsets):
+                continue
+            new_ts = anchor_ts + int((self.offsets[index] - base) * factor)
+            if new_ts != due_ts:
+                topic.reschedule(index, new_ts)
+                changed.append(index)
+        return changed
+
+    def plan_batch(self, topics):
+        """plan() для всех тем сразу; возвращает изменившиеся темы"""
+        if np is None:
+            return [topic for topic in topics if self.plan(topic)]
+        groups = {}
+        for topic in topics:
+            groups.setdefault(len(topic), []).append(topic)
+        changed = []
+        for length, group in groups.items():
+            if length:
+                changed.extend(self._plan_group(group, length))
+        return changed
+
+    def _plan_group(self, group, length):
+        """Векторный пересчёт тем с одинаковым числом повторений"""
+        count = len(group)
+        rep = np.frombuffer(b''.join(topic.rep_ts.tobytes() for topic in group), dtype=np.int64).reshape(count, length)
+        study = np.fromiter((topic.study_ts for topic in group), dtype=np.int64, count=count)
+        done_mask = np.fromiter((topic.done_mask for topic in group), dtype=np.int64, count=count)
+        sent_mask = np.fromiter((topic.sent_mask for topic in group), dtype=np.int64, count=count)
+        columns = np.arange(length)
+        done = (done_mask[:, None] >> columns) & 1 == 1
+
+        known = min(length, len(self.offsets))
+        offsets = np.zeros(length, dtype=np.int64)
+        offsets[:known] = self.offsets[:known]
+
+        if self.adaptive:
+            ease = np.fromiter((topic.ease for topic in group), dtype=np.float64, count=count)
+            last = np.where(done.any(axis=1), length - 1 - np.argmax(done[:, ::-1], axis=1), -1)
+            rows = np.arange(count)
+            anchor = np.where(last >= 0, rep[rows, np.maximum(last, 0)], study)
+            base = np.where(last >= 0, offsets[np.maximum(last, 0)], 0)
+            factor = ease / DEFAULT_EASE
+        else:
+            last = np.full(count, -1)
+            anchor, base, factor = study, np.zeros(count, dtype=np.int64), np.ones(count)
+
+        delta = ((offsets[None, :] - base[:, None]) * factor[:, None]).astype(np.int64)
+        planned = anchor[:, None] + delta
+        movable = ~done & (columns[None, :] > last[:, None]) & (columns[None, :] < known)
+        moved = movable & (planned != rep)
+
+        touched = np.flatnonzero(moved.any(axis=1))
+        new_rep = np.where(moved, planned, rep)
+        cleared = (moved.astype(np.int64) << columns).sum(axis=1)
+        new_sent = sent_mask & ~cleared
+        # Строки обратно в array('q') прямо из байтов, без списков Python
+        rows = memoryview(np.ascontiguousarray(new_rep[touched]).tobytes())
+        step = length * 8
+        changed = []
+        for offset, position, sent in zip(range(0, len(rows), step), touched.tolist(), new_sent[touched].tolist()):
+            topic = group[position]
+            topic.rep_ts = array('q')
+            topic.rep_ts.frombytes(rows[offset:offset + step])
+            topic.sent_mask = sent
+            changed.append(topic)
+        return changed
+
+
+class SM2(FixedIntervals):
+    """Промежутки от момента выполнения с коэффициентом лёгкости SM-2"""
+
+    name = 'sm2'
+    adaptive = True
+
+    def update_ease(self, ease, grade):
+        quality = GRADES.get(grade, GRADES['good'])
+        return max(MIN_EASE, round(ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02), 2))
+
+    def factor(self, ease):
+        return ease / DEFAULT_EASE
+
+    def anchor(self, topic):
+        last = topic.done_mask.bit_length() - 1
+        return (topic.rep_ts[last] if last >= 0 else topic.study_ts), last
+
+
+ALGORITHMS = {algorithm.name: algorithm for algorithm in (FixedIntervals, SM2)}
+
+
+def get_algorithm(name, intervals):
+    """Алгоритм по имени из SRS_ALGORITHM"""
+    try:
+        return ALGORITHMS[name](intervals)
+    except KeyError:
+        raise ValueError(f"Неизвестный алгоритм повторений: {name} (доступны: {', '.join(ALGORITHMS)})")
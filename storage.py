@@ -0,0 +1,431 @@
+"""Хранилища данных пользователей
+
+Бот работает с хранилищем через небольшой интерфейс:
+
+    load(shard=None)                    -> {user_id: [запись темы, ...]}
+    load_user(user_id)                  -> [запись темы, ...]
+    load_pending(shard=None)            -> [(user_id, запись), ...] только темы
+                                           с невыполненными повторениями
+    save_topic(user_id, record)         - запись одной темы (по record['id'])
+    save_topics([(user_id, record)])    - запись пачки тем одной транзакцией
+    acquire_lease(name, owner, ttl)     -> True, если аренда name за owner
+    release_lease(name, owner)
+    active_leases(prefix)               -> {имя: владелец} неистёкших аренд
+    load_dialogs(shard=None)            -> {user_id: состояние диалога}
+    save_dialogs(data)                  - запись состояний диалогов пачкой;
+                                          пустое состояние удаляет запись
+    close()
+
+shard - пара (число шардов, номер шарда): читаются только пользователи с
+user_id % число == номер (см. sharding.py). Аренды нужны, чтобы один шард
+не обслуживали два процесса сразу. Состояние диалога - context.user_data
+пользователя (например, бот ждёт дату новой темы), JSON-совместимый словарь.
+
+Запись темы - JSON-совместимый словарь (см. model.Topic.to_record). Темы
+пользователя упорядочены по id; у записей старого формата id нет, им
+назначается номер позиции в списке, начиная с 1.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import SIZE_BUCKETS, Histogram
+
+SAVE_SECONDS = Histogram('bot_storage_save_seconds', "Длительность записи в хранилище", ['op'])
+SAVE_BYTES = Histogram('bot_storage_save_bytes', "Объём данных, записанных за одну операцию", ['op'], buckets=SIZE_BUCKETS)
+
+
+def _atomic_write_json(path, data):
+    """Атомарно записывает JSON: временный файл + fsync + os.replace
+
+    Возвращает размер записанного файла в байтах.
+    """
+    raw = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(raw)
+
+
+def is_pending(record):
+    """Есть ли в записи темы невыполненные повторения (оба формата записи)"""
+    if 'reps' in record:
+        return record['done'] != (1 << len(record['reps'])) - 1
+    return not all(rep['completed'] for rep in record['repetitions'])
+
+
+def with_ids(topics):
+    """Проставляет id записям старого формата (позиция в списке + 1)"""
+    for index, record in enumerate(topics):
+        record.setdefault('id', index + 1)
+    return topics
+
+
+def in_shard(user_id, shard):
+    return shard is None or user_id % shard[0] == shard[1]
+
+
+def read_legacy_json(path):
+    """Читает файл в старом формате user_data.json"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return {int(user_id): with_ids(list(topics)) for user_id, topics in data.items()}
+
+
+class JsonStorage:
+    """Все данные в одном JSON-файле (прежний формат user_data.json)
+
+    Каждая запись переписывает файл целиком, поэтому бэкенд годится только
+    для небольших объёмов. Файл заменяется атомарно, так что сбой во время
+    записи не портит предыдущую версию. С файлом работает один процесс,
+    поэтому аренды всегда выдаются. Состояния диалогов лежат рядом, в
+    отдельном файле *_dialogs.json, чтобы не менять формат основного.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dialogs_path = f"{os.path.splitext(path)[0]}_dialogs.json"
+        self._data = {}
+        self._dialogs = {}
+        self._lock = threading.Lock()
+
+    def load(self, shard=None):
+        with self._lock:
+            self._data = read_legacy_json(self.path) if os.path.exists(self.path) else {}
+            return {user_id: list(topics) for user_id, topics in self._data.items() if in_shard(user_id, shard)}
+
+    def load_user(self, user_id):
+        with self._lock:
+            return list(self._data.get(user_id, []))
+
+    def load_pending(self, shard=None):
+        self.load()
+        with self._lock:
+            return [
+                (user_id, record)
+                for user_id, topics in self._data.items() if in_shard(user_id, shard)
+                for record in topics
+                if is_pending(record)
+            ]
+
+    def save_topic(self, user_id, record):
+        with self._lock, SAVE_SECONDS.time(op='save_topic'):
+            topics = self._data.setdefault(user_id, [])
+            for index, existing in enumerate(topics):
+                if existing['id'] == record['id']:
+                    topics[index] = record
+                    break
+            else:
+                topics.append(record)
+            self._write('save_topic')
+
+    def save_topics(self, items):
+        with self._lock, SAVE_SECONDS.time(op='save_topics'):
+            positions = {}
+            for user_id, record in items:
+                topics = self._data.setdefault(user_id, [])
+                if user_id not in positions:
+                    positions[user_id] = {existing['id']: index for index, existing in enumerate(topics)}
+                index = positions[user_id].get(record['id'])
+                if index is None:
+                    positions[user_id][record['id']] = len(topics)
+                    topics.append(record)
+                else:
+                    topics[index] = record
+            self._write('save_topics')
+
+    def acquire_lease(self, name, owner, ttl):
+        return True
+
+    def release_lease(self, name, owner):
+        pass
+
+    def active_leases(self, prefix):
+        return {}
+
+    def load_dialogs(self, shard=None):
+        with self._lock:
+            if os.path.exists(self.dialogs_path):
+                with open(self.dialogs_path, 'r', encoding='utf-8') as f:
+                    self._dialogs = {int(user_id): state for user_id, state in json.load(f).items()}
+            return {user_id: state for user_id, state in self._dialogs.items() if in_shard(user_id, shard)}
+
+    def save_dialogs(self, data):
+        with self._lock, SAVE_SECONDS.time(op='save_dialogs'):
+            for user_id, state in data.items():
+                if state:
+                    self._dialogs[user_id] = state
+                else:
+                    self._dialogs.pop(user_id, None)
+            size = _atomic_write_json(self.dialogs_path, {str(user_id): state for user_id, state in self._dialogs.items()})
+        SAVE_BYTES.observe(size, op='save_dialogs')
+
+    def _write(self, op):
+        size = _atomic_write_json(self.path, {str(user_id): topics for user_id, topics in self._data.items()})
+        SAVE_BYTES.observe(size, op=op)
+
+    def close(self):
+        pass
+
+
+BUSY_TIMEOUT = 30
+
+# Миграции схемы SQLite; номер версии хранится в PRAGMA user_version
+_MIGRATIONS = [
+    (
+        """
+        CREATE TABLE topics (
+            user_id INTEGER NOT NULL,
+            idx     INTEGER NOT NULL,
+            data    TEXT    NOT NULL,
+            PRIMARY KEY (user_id, idx)
+        )
+        """,
+    ),
+    (
+        # Индекс тем с невыполненными повторениями для быстрого старта.
+        # Старые строки считаются незавершёнными до следующей записи.
+        "ALTER TABLE topics ADD COLUMN pending INTEGER NOT NULL DEFAULT 1",
+        "CREATE INDEX topics_pending ON topics (user_id, idx) WHERE pending = 1",
+    ),
+    (
+        # Ключ строки - постоянный id темы вместо позиции в списке
+        """
+        CREATE TABLE topics_v3 (
+            user_id  INTEGER NOT NULL,
+            topic_id INTEGER NOT NULL,
+            data     TEXT    NOT NULL,
+            pending  INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (user_id, topic_id)
+        )
+        """,
+        """
+        INSERT INTO topics_v3 (user_id, topic_id, data, pending)
+        SELECT user_id, COALESCE(json_extract(data, '$.id'), idx + 1), data, pending FROM topics
+        """,
+        "DROP TABLE topics",
+        "ALTER TABLE topics_v3 RENAME TO topics",
+        "CREATE INDEX topics_pending ON topics (user_id, topic_id) WHERE pending = 1",
+    ),
+    (
+        # Аренды шардов: какой процесс сейчас обслуживает шард
+        """
+        CREATE TABLE leases (
+            name       TEXT PRIMARY KEY,
+            owner      TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """,
+    ),
+    (
+        # Состояние диалогов (context.user_data), чтобы переживать перезапуск
+        """
+        CREATE TABLE dialogs (
+            user_id INTEGER PRIMARY KEY,
+            data    TEXT    NOT NULL
+        )
+        """,
+    ),
+]
+
+
+class SqliteStorage:
+    """SQLite в режиме WAL: одна строка на тему
+
+    Изменение темы - это одна короткая транзакция, а не переписывание всех
+    данных. WAL даёт читателям согласованный снимок, пока идёт запись, и
+    переживает обрыв процесса без порчи базы. С одной базой могут работать
+    несколько процессов (воркеры шардов): запись ждёт освобождения базы до
+    BUSY_TIMEOUT секунд.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+
+    def _migrate(self):
+        # Версия читается внутри транзакции: воркеры, запущенные разом,
+        # применяют каждую миграцию по очереди, а не все одновременно
+        while True:
+            with self._transaction():
+                version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(_MIGRATIONS):
+                    return
+                for sql in _MIGRATIONS[version]:
+                    self._conn.execute(sql)
+                self._conn.execute(f"PRAGMA user_version = {version + 1}")
+
+    def _transaction(self):
+        return _Transaction(self._conn)
+
+    def save_all_if_empty(self, data):
+        """Записывает data, только если тем в базе ещё нет; True, если записали"""
+        rows = [_row(user_id, record) for user_id, topics in data.items() for record in with_ids(list(topics))]
+        with self._lock, self._transaction():
+            if self._conn.execute("SELECT 1 FROM topics LIMIT 1").fetchone() is not None:
+                return False
+            self._conn.executemany("INSERT INTO topics (user_id, topic_id, data, pending) VALUES (?, ?, ?, ?)", rows)
+        return True
+
+    def load(self, shard=None):
+        data = {}
+        where, params = _shard_filter(shard)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT user_id, topic_id, data FROM topics WHERE {where} ORDER BY user_id, topic_id", params
+            ).fetchall()
+        for user_id, topic_id, raw in rows:
+            data.setdefault(user_id, []).append(_record(topic_id, raw))
+        return data
+
+    def load_user(self, user_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT topic_id, data FROM topics WHERE user_id = ? ORDER BY topic_id", (user_id,)
+            ).fetchall()
+        return [_record(topic_id, raw) for topic_id, raw in rows]
+
+    def load_pending(self, shard=None):
+        where, params = _shard_filter(shard)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT user_id, topic_id, data FROM topics WHERE pending = 1 AND {where}", params
+            ).fetchall()
+        return [(user_id, _record(topic_id, raw)) for user_id, topic_id, raw in rows]
+
+    def save_topic(self, user_id, record):
+        with SAVE_SECONDS.time(op='save_topic'):
+            row = _row(user_id, record)
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO topics (user_id, topic_id, data, pending) VALUES (?, ?, ?, ?)", row
+                )
+        SAVE_BYTES.observe(len(row[2]), op='save_topic')
+
+    def save_topics(self, items):
+        with SAVE_SECONDS.time(op='save_topics'):
+            rows = [_row(user_id, record) for user_id, record in items]
+            with self._lock, self._transaction():
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO topics (user_id, topic_id, data, pending) VALUES (?, ?, ?, ?)", rows
+                )
+        SAVE_BYTES.observe(sum(len(row[2]) for row in rows), op='save_topics')
+
+    def acquire_lease(self, name, owner, ttl):
+        """Берёт или продлевает аренду, если она свободна, истекла или уже наша"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                """
+                INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+                """,
+                (name, owner, now + ttl, now)
+            )
+            return cursor.rowcount == 1
+
+    def release_lease(self, name, owner):
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def active_leases(self, prefix):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, owner FROM leases WHERE substr(name, 1, ?) = ? AND expires_at >= ?",
+                (len(prefix), prefix, time.time())
+            ).fetchall()
+        return dict(rows)
+
+    def load_dialogs(self, shard=None):
+        where, params = _shard_filter(shard)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT user_id, data FROM dialogs WHERE {where}", params).fetchall()
+        return {user_id: json.loads(raw) for user_id, raw in rows}
+
+    def save_dialogs(self, data):
+        with SAVE_SECONDS.time(op='save_dialogs'):
+            rows = [(user_id, json.dumps(state, ensure_ascii=False)) for user_id, state in data.items() if state]
+            with self._lock, self._transaction():
+                self._conn.executemany("DELETE FROM dialogs WHERE user_id = ?", [(user_id,) for user_id, state in data.items() if not state])
+                self._conn.executemany("INSERT OR REPLACE INTO dialogs (user_id, data) VALUES (?, ?)", rows)
+        SAVE_BYTES.observe(sum(len(row[1]) for row in rows), op='save_dialogs')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _shard_filter(shard):
+    if shard is None:
+        return "1", ()
+    return "user_id % ? = ?", shard
+
+
+def _row(user_id, record):
+    return user_id, record['id'], json.dumps(record, ensure_ascii=False), int(is_pending(record))
+
+
+def _record(topic_id, raw):
+    record = json.loads(raw)
+    record.setdefault('id', topic_id)
+    return record
+
+
+class _Transaction:
+    """BEGIN/COMMIT вокруг блока, ROLLBACK при исключении"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc, tb):
+        self._conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def migrate_legacy_json(storage, json_path):
+    """Переносит старый user_data.json в пустую базу SQLite
+
+    После успешного переноса файл переименовывается в *.migrated, чтобы
+    повторный запуск не импортировал его снова. Безопасно при одновременном
+    запуске нескольких процессов: проверка пустоты и запись идут одной
+    транзакцией, так что переносит только один. Возвращает число тем.
+    """
+    if not os.path.exists(json_path):
+        return 0
+    try:
+        data = read_legacy_json(json_path)
+    except FileNotFoundError:  # Файла нет или его уже перенёс другой процесс
+        return 0
+    if not storage.save_all_if_empty(data):
+        return 0
+    try:
+        os.replace(json_path, f"{json_path}.migrated")
+    except FileNotFoundError:
+        pass
+    return sum(len(topics) for topics in data.values())
+
+
+def open_storage(backend, db_path, json_path):
+    """Открывает хранилище по имени бэкенда ('sqlite' или 'json')"""
+    if backend == 'json':
+        return JsonStorage(json_path)
+    if backend == 'sqlite':
+        storage = SqliteStorage(db_path)
+        migrated = migrate_legacy_json(storage, json_path)
+        if migrated:
+            print(f"📦 Перенесено {migrated} тем из {json_path} в {db_path}")
+        return storage
+    raise ValueError(f"Неизвестный бэкенд хранилища: {backend}")
@@ -0,0 +1,263 @@
+"""Бенчмарки горячих путей бота на синтетических данных
+
+    python tools/bench.py --scale 1000x20 --scale 10000x20 --out bench.json
+    python tools/bench.py --scale 1000x20 --compare bench.json
+
+Для каждого масштаба (пользователи x темы) в отдельной временной базе
+замеряются save_topics (запись всех тем пачкой, как это делает
+WriteBehind), save_topic, load_data (полная и ленивая загрузка),
+schedule_reminders, отрисовка /list и /done (с пустым и с прогретым
+кэшем) и полный путь /newtopic через handle_text_input. Обработчики
+работают с настоящими объектами Update, а вместо Telegram - заглушка Bot.
+
+С --compare результаты сверяются с сохранёнными ранее: если p50 операции
+вырос больше чем в --threshold раз, скрипт завершается с кодом 1.
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from telegram import Update  # noqa: E402
+
+import main  # noqa: E402
+from model import Topic  # noqa: E402
+
+# Синтетические данные строятся в секундах от начала 40-дневного окна и
+# сдвигаются к моменту запуска целиком: при том же --seed расписание,
+# выполненные повторения и доля просроченных совпадают в любой день, а
+# schedule_reminders по-прежнему видит будущие сроки
+HISTORY = 40 * 86400
+BASE_TS = int(time.time()) - HISTORY
+SAMPLE = 200  # замеров на операцию для перцентилей
+
+
+class StubBot:
+    """Заглушка telegram.Bot: принимает вызовы и ничего не отправляет"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def _call(self, *args, **kwargs):
+        self.calls += 1
+        return True
+
+    send_message = edit_message_text = edit_message_reply_markup = answer_callback_query = _call
+
+
+def synthetic_data(users, topics_per_user, seed=1):
+    """Темы со случайным временем изучения за последние 40 дней"""
+    rng = random.Random(seed)
+    now = BASE_TS + HISTORY
+    data = {}
+    for user_id in range(1, users + 1):
+        topics = []
+        for topic_id in range(1, topics_per_user + 1):
+            topic = Topic.create(topic_id, f"Тема {topic_id} пользователя {user_id}",
+                                 main.from_timestamp(BASE_TS + rng.randrange(HISTORY)), main.INTERVALS)
+            for rep_index, due_ts in enumerate(topic.rep_ts):
+                if due_ts < now and rng.random() < 0.8:
+                    topic.mark_done(rep_index)
+            topics.append(topic)
+        data[user_id] = topics
+    return data
+
+
+def text_update(bot, update_id, user_id, text):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench'},
+        'text': text,
+    }
+    return Update.de_json({'update_id': update_id, 'message': message}, bot)
+
+
+def summarize(name, samples, items=1):
+    """Перцентили в миллисекундах и пропускная способность"""
+    samples = sorted(samples)
+    quantiles = statistics.quantiles(samples, n=100, method='inclusive') if len(samples) > 1 else samples * 99
+    total = sum(samples)
+    return {
+        'name': name,
+        'runs': len(samples),
+        'p50_ms': round(quantiles[49] * 1000, 3),
+        'p95_ms': round(quantiles[94] * 1000, 3),
+        'p99_ms': round(quantiles[98] * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+        'ops_per_sec': round(len(samples) * items / total, 1) if total else None,
+    }
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+async def timed_async(coro):
+    started = time.perf_counter()
+    await coro
+    return time.perf_counter() - started
+
+
+def save_all_topics(data):
+    """Все темы одной пачкой: mark() и запись, как у фоновой задачи WriteBehind"""
+    writer = main.get_writer()
+    for user_id, topics in data.items():
+        for topic in topics:
+            writer.mark(user_id, topic.to_record())
+    writer.flush_sync()
+
+
+def reset_main(db_path, lazy):
+    if main.storage is not None:
+        main.storage.close()
+    main.storage = None
+    main.writer = None
+    main.DB_FILE = db_path
+    # Иначе user_data.json из текущего каталога перенёсся бы во временную базу
+    main.DATA_FILE = os.path.join(os.path.dirname(db_path), 'user_data.json')
+    main.LAZY_STARTUP = lazy
+    main.user_data = {}
+    main.topics_by_id = {}
+    main.view_cache.clear()
+    main.due_index.clear()
+    main.scheduler = None
+    main.catchup = None
+
+
+async def stop_dispatchers():
+    # Сводки пропущенных повторений в бенчмарке не отправляются
+    await main.scheduler.stop()
+    await main.catchup.stop()
+
+
+async def bench_scale(users, topics_per_user, repeat, seed):
+    results = []
+    bot = StubBot()
+    application = SimpleNamespace(bot=bot)
+    total_topics = users * topics_per_user
+    data = synthetic_data(users, topics_per_user, seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+
+        # save_topics: все темы одной пачкой через отложенную запись
+        reset_main(db_path, lazy=False)
+        results.append(summarize('save_topics', [timed(save_all_topics, data) for _ in range(repeat)], total_topics))
+
+        # save_topic: запись одной темы
+        sample = [(user_id, random.choice(topics)) for user_id, topics in itertools.islice(data.items(), SAMPLE)]
+        results.append(summarize('save_topic', [timed(main.save_topic, user_id, topic) for user_id, topic in sample]))
+
+        # load_data + schedule_reminders в обоих режимах запуска
+        for lazy in (False, True):
+            mode = 'lazy' if lazy else 'eager'
+            load, schedule = [], []
+            for _ in range(repeat):
+                reset_main(db_path, lazy)
+                load.append(timed(main.load_data))
+                schedule.append(timed(main.schedule_reminders, application))
+                await stop_dispatchers()
+            results.append(summarize(f'load_data[{mode}]', load, total_topics))
+            results.append(summarize(f'schedule_reminders[{mode}]', schedule, total_topics))
+
+        # Отрисовка /list и /done через настоящие обработчики
+        reset_main(db_path, lazy=False)
+        main.load_data()
+        main.schedule_reminders(application)
+        await main.catchup.stop()
+        user_ids = random.sample(list(data), min(SAMPLE, users))
+        counter = itertools.count(1)
+        for name, kind, handler in (('list_topics', 'list', main.list_topics), ('mark_done', 'done', main.mark_done)):
+            cold, warm = [], []
+            for user_id in user_ids:
+                context = SimpleNamespace(user_data={}, application=application)
+                main.invalidate_view(user_id)
+                cold.append(await timed_async(handler(text_update(bot, next(counter), user_id, f'/{kind}'), context)))
+                warm.append(await timed_async(handler(text_update(bot, next(counter), user_id, f'/{kind}'), context)))
+            results.append(summarize(f'{name}[cold]', cold))
+            results.append(summarize(f'{name}[cached]', warm))
+
+        # Полный путь /newtopic: тема, затем дата
+        newtopic = []
+        for user_id in user_ids:
+            context = SimpleNamespace(user_data={'waiting_for': 'topic'}, application=application)
+            started = time.perf_counter()
+            await main.handle_text_input(text_update(bot, next(counter), user_id, 'Новая тема'), context)
+            await main.handle_text_input(text_update(bot, next(counter), user_id, 'сейчас'), context)
+            newtopic.append(time.perf_counter() - started)
+        results.append(summarize('handle_text_input[newtopic]', newtopic))
+
+        await stop_dispatchers()
+        reset_main(db_path, lazy=True)
+
+    return results
+
+
+def compare(results, baseline_path, threshold):
+    """Список регрессий относительно сохранённых результатов"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    previous = {(run['scale'], op['name']): op for run in baseline['runs'] for op in run['results']}
+    regressions = []
+    for run in results:
+        for op in run['results']:
+            old = previous.get((run['scale'], op['name']))
+            if old and old['p50_ms'] and op['p50_ms'] > old['p50_ms'] * threshold:
+                regressions.append(f"{run['scale']} {op['name']}: p50 {old['p50_ms']} -> {op['p50_ms']} мс")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', action='append', help="пользователи x темы, например 1000x20")
+    parser.add_argument('--repeat', type=int, default=3, help="повторов для тяжёлых операций")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help="файл для результатов в JSON")
+    parser.add_argument('--compare', help="JSON с прошлыми результатами")
+    parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    runs = []
+    for scale in args.scale or ['1000x20']:
+        users, topics = (int(part) for part in scale.lower().split('x'))
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = asyncio.run(bench_scale(users, topics, args.repeat, args.seed))
+        runs.append({'scale': scale, 'users': users, 'topics_per_user': topics, 'results': results})
+
+        print(f"\n📊 {users} пользователей x {topics} тем")
+        print(f"{'операция':<30}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'оп/с':>14}")
+        for op in results:
+            print(f"{op['name']:<30}{op['p50_ms']:>10.2f}{op['p95_ms']:>10.2f}{op['p99_ms']:>10.2f}{op['ops_per_sec'] or 0:>14.0f}")
+
+    report = {'timestamp': int(time.time()), 'python': sys.version.split()[0], 'runs': runs}
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Результаты сохранены в {args.out}")
+
+    if args.compare:
+        regressions = compare(runs, args.compare, args.threshold)
+        for line in regressions:
+            print(f"❌ Регрессия: {line}")
+        if regressions:
+            sys.exit(1)
+        print("✅ Регрессий нет")
+
+
+if __name__ == '__main__':
+    main_cli()
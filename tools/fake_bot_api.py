@@ -0,0 +1,294 @@
+"""Локальный сервер-заменитель Telegram Bot API для нагрузочных тестов
+
+    python tools/fake_bot_api.py --port 8081 --latency 50 --jitter 20 --error-rate 0.01
+    BOT_TOKEN=123:abc BOT_API_URL=http://127.0.0.1:8081/bot python main.py
+
+Поддерживаются методы, которыми пользуется бот: getMe, getUpdates
+(long polling с offset), setWebhook/deleteWebhook/getWebhookInfo,
+sendMessage, sendDocument, editMessageText, editMessageReplyMarkup,
+answerCallbackQuery; остальные просто отвечают true. Каждый ответ можно
+задержать (--latency и --jitter, мс), а долю запросов на отправку -
+отклонить с 429 Too Many Requests и retry_after, как это делает Telegram.
+
+Обновления для бота подкладываются через служебный POST /_inject (одно
+обновление или список). Пока установлен webhook, сервер сам отправляет
+их на адрес webhook с секретом, как Telegram, иначе отдаёт через
+getUpdates. GET /_stats - счётчики вызовов по методам и выданных ошибок.
+
+Из Python сервер запускается как FakeBotApi(...).start(); on_send
+вызывается из потока сервера для каждого доставленного сообщения
+(см. tools/loadtest.py).
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# Методы, на которые может прийти 429 (getUpdates и служебные не ограничиваются)
+SEND_METHODS = {
+    'sendMessage', 'sendDocument', 'editMessageText', 'editMessageReplyMarkup', 'answerCallbackQuery',
+}
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+MAX_WEBHOOK_CONNECTIONS = 40  # как max_connections у Telegram по умолчанию
+
+
+def parse_body(content_type, raw):
+    """Параметры запроса: JSON, form-urlencoded или multipart (файлы пропускаются)"""
+    if not raw:
+        return {}
+    if 'json' in content_type:
+        return json.loads(raw)
+    if 'x-www-form-urlencoded' in content_type:
+        return {key: values[0] for key, values in parse_qs(raw.decode('utf-8')).items()}
+    if 'multipart/form-data' in content_type:
+        message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + raw)
+        return {
+            part.get_param('name', header='content-disposition'): part.get_payload(decode=True).decode('utf-8', 'replace')
+            for part in message.get_payload()
+            if part.get_filename() is None
+        }
+    return {}
+
+
+class FakeBotApi:
+    """Bot API в памяти поверх ThreadingHTTPServer
+
+    latency и jitter - секунды, error_rate - доля запросов на отправку,
+    получающих 429 с retry_after секунд.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, retry_after=1,
+                 on_send=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.on_send = on_send
+        self.calls = Counter()
+        self.errors = Counter()
+        self.webhook_url = None
+        self.webhook_secret = None
+        self._random = random.Random(seed)
+        self._updates = deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._pusher = None
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    @property
+    def url(self):
+        """Значение BOT_API_URL для бота"""
+        return f"http://{self.host}:{self.port}/bot"
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._pusher is not None:
+            self._pusher.shutdown(wait=False, cancel_futures=True)
+
+    def inject(self, update):
+        """Ставит обновление в очередь бота; update_id назначается, если его нет"""
+        update = dict(update)
+        update.setdefault('update_id', next(self._update_ids))
+        with self._cond:
+            if self.webhook_url:
+                self._push(update)
+            else:
+                self._updates.append(update)
+                self._cond.notify_all()
+        return update['update_id']
+
+    def wait_for(self, method, timeout):
+        """Ждёт первого вызова method ботом; True, если дождались"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.calls[method]:
+                return True
+            time.sleep(0.05)
+        return False
+
+    # Обработка вызовов Bot API
+
+    def call(self, method, params):
+        """(HTTP-код, тело ответа) для вызова метода"""
+        self.calls[method] += 1
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if method in SEND_METHODS and self.error_rate and self._random.random() < self.error_rate:
+            self.errors[method] += 1
+            return 429, {
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            }
+        handler = getattr(self, f"_api_{method}", None)
+        if handler is None:
+            return 200, {'ok': True, 'result': True}
+        result = handler(params)
+        if isinstance(result, tuple):
+            return result
+        return 200, {'ok': True, 'result': result}
+
+    def _api_getMe(self, params):
+        return BOT_USER
+
+    def _api_getUpdates(self, params):
+        if self.webhook_url:
+            return 409, {'ok': False, 'error_code': 409,
+                         'description': "Conflict: can't use getUpdates method while webhook is active"}
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # offset подтверждает все обновления до него
+            while self._updates and self._updates[0]['update_id'] < offset:
+                self._updates.popleft()
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return list(itertools.islice(self._updates, limit))
+
+    def _api_setWebhook(self, params):
+        with self._cond:
+            self.webhook_url = params.get('url') or None
+            self.webhook_secret = params.get('secret_token')
+            if str(params.get('drop_pending_updates')).lower() == 'true':
+                self._updates.clear()
+            if self.webhook_url:
+                while self._updates:
+                    self._push(self._updates.popleft())
+            self._cond.notify_all()
+        return True
+
+    def _api_deleteWebhook(self, params):
+        with self._cond:
+            self.webhook_url = None
+            if str(params.get('drop_pending_updates')).lower() == 'true':
+                self._updates.clear()
+        return True
+
+    def _api_getWebhookInfo(self, params):
+        return {'url': self.webhook_url or '', 'has_custom_certificate': False, 'pending_update_count': len(self._updates)}
+
+    def _api_sendMessage(self, params):
+        return self._message(params, 'sendMessage', text=params.get('text', ''))
+
+    def _api_sendDocument(self, params):
+        return self._message(params, 'sendDocument', caption=params.get('caption', ''))
+
+    def _message(self, params, method, **content):
+        chat_id = int(params['chat_id'])
+        if self.on_send is not None:
+            self.on_send(time.time(), method, chat_id, params)
+        return {
+            'message_id': next(self._message_ids), 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'}, 'from': BOT_USER, **content,
+        }
+
+    # Доставка обновлений на webhook
+
+    def _push(self, update):
+        if self._pusher is None:
+            self._pusher = ThreadPoolExecutor(max_workers=MAX_WEBHOOK_CONNECTIONS)
+        self._pusher.submit(self._post_webhook, self.webhook_url, self.webhook_secret, update)
+
+    def _post_webhook(self, url, secret, update):
+        headers = {'Content-Type': 'application/json'}
+        if secret:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+        request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), headers=headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=30):
+                pass
+        except (urllib.error.URLError, OSError):
+            self.errors['webhook'] += 1
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело уходят отдельными записями: без TCP_NODELAY
+            # Nagle и отложенный ACK добавляют ~40 мс к каждому ответу
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == '/_stats':
+                    self._reply(200, {'calls': dict(api.calls), 'errors': dict(api.errors), 'webhook': api.webhook_url})
+                else:
+                    self._reply(404, {'ok': False, 'error_code': 404, 'description': "Not Found"})
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                try:
+                    params = parse_body(self.headers.get('Content-Type', ''), raw)
+                except ValueError:
+                    self._reply(400, {'ok': False, 'error_code': 400, 'description': "Bad Request: can't parse body"})
+                    return
+                if self.path == '/_inject':
+                    updates = params if isinstance(params, list) else [params]
+                    self._reply(200, {'ok': True, 'result': [api.inject(update) for update in updates]})
+                    return
+                # /bot<token>/<метод>
+                _, _, method = self.path.rpartition('/')
+                status, body = api.call(method, params)
+                self._reply(status, body)
+
+            def _reply(self, status, body):
+                data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0, help="задержка каждого ответа, мс")
+    parser.add_argument('--jitter', type=float, default=0, help="случайная добавка к задержке, до N мс")
+    parser.add_argument('--error-rate', type=float, default=0, help="доля отправок, получающих 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429, с")
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.host, args.port, args.latency / 1000, args.jitter / 1000, args.error_rate, args.retry_after)
+    print(f"🧪 Bot API на {api.url} (BOT_API_URL для бота)")
+    try:
+        api.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"📊 Вызовы: {dict(api.calls)}, выдано ошибок: {dict(api.errors)}")
+
+
+if __name__ == '__main__':
+    main()
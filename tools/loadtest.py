@@ -0,0 +1,431 @@
+"""Нагрузочный тест бота против локального Bot API
+
+    python tools/loadtest.py --users 1000 --rounds 2 --ramp 20
+    python tools/loadtest.py --users 500 --latency 40 --jitter 20 --error-rate 0.01 --out loadtest.json
+    python tools/loadtest.py --users 200 --mode webhook
+
+Скрипт поднимает FakeBotApi (tools/fake_bot_api.py), запускает настоящий
+main.py отдельным процессом с BOT_API_URL этого сервера и временной базой
+и гоняет --users виртуальных пользователей. Каждый --rounds раз проходит
+/newtopic (название, дата), /list и /done (номер темы, номер повторения)
+и ждёт ответа бота на каждый шаг, прежде чем сделать следующий.
+
+Дата изучения подбирается так, чтобы первое повторение темы наступило во
+время теста (через --reminder-delay секунд, вразброс на --reminder-spread
+минут), поэтому заодно проверяется доставка напоминаний: сколько дошло и
+насколько позже срока. С --no-reminders дата - «сейчас».
+
+Отчёт: пропускная способность, перцентили задержки ответа по шагам (от
+передачи обновления боту до его sendMessage), доля ошибок (таймауты,
+ошибки обработчиков из /metrics бота, выданные 429), точность напоминаний,
+CPU и память процесса бота.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import Counter, defaultdict
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(TOOLS_DIR, '..')
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, TOOLS_DIR)
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+from main import INTERVALS, format_time  # noqa: E402
+
+BOT_TOKEN = '123456:LOADTEST'
+BASE_USER_ID = 1_000_000
+STARTUP_TIMEOUT = 60
+STOP_TIMEOUT = 60
+REMINDER_GRACE = 60  # сколько ждать напоминаний после последнего срока, с
+STEPS = ('newtopic', 'topic', 'date', 'list', 'done', 'done_topic', 'done_rep')
+
+
+def make_update(user_id, text):
+    """Текстовое сообщение пользователя; update_id назначает FakeBotApi"""
+    message = {
+        'message_id': random.randrange(1, 2 ** 31),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"Load{user_id}"},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'message': message}
+
+
+def percentiles(values):
+    """p50/p95/p99/max в миллисекундах"""
+    if not values:
+        return None
+    values = sorted(values)
+    quantiles = statistics.quantiles(values, n=100, method='inclusive') if len(values) > 1 else values * 99
+    return {
+        'p50_ms': round(quantiles[49] * 1000, 1), 'p95_ms': round(quantiles[94] * 1000, 1),
+        'p99_ms': round(quantiles[98] * 1000, 1), 'max_ms': round(values[-1] * 1000, 1), 'count': len(values),
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def scrape_metrics(port):
+    """Сумма значений каждой метрики с /metrics бота (по всем меткам)"""
+    totals = Counter()
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            text = response.read().decode('utf-8')
+    except OSError as e:
+        print(f"⚠️ /metrics бота недоступен: {e}")
+        return totals
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, _, value = line.rpartition(' ')
+        try:
+            totals[name.split('{')[0]] += float(value)
+        except ValueError:
+            continue
+    return totals
+
+
+class ProcessSampler:
+    """CPU и RSS процесса бота по /proc раз в interval секунд (только Linux)"""
+
+    def __init__(self, pid, interval=1.0):
+        self.pid = pid
+        self.interval = interval
+        self.available = os.path.exists(f"/proc/{pid}/stat")
+        self.ticks = os.sysconf('SC_CLK_TCK') if self.available else 100
+        self.cpu_peak = 0.0
+        self.rss_peak = 0
+        self._first = None
+        self._last = None
+
+    def _read(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            # Поля после имени процесса (оно в скобках и может содержать пробелы)
+            fields = f.read().rpartition(')')[2].split()
+        cpu = (int(fields[11]) + int(fields[12])) / self.ticks
+        rss = 0
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                    break
+        return time.monotonic(), cpu, rss
+
+    def sample(self):
+        try:
+            now, cpu, rss = self._read()
+        except (OSError, ValueError, IndexError):
+            return
+        if self._last is not None and now > self._last[0]:
+            self.cpu_peak = max(self.cpu_peak, (cpu - self._last[1]) / (now - self._last[0]))
+        self._first = self._first or (now, cpu)
+        self._last = (now, cpu)
+        self.rss_peak = max(self.rss_peak, rss)
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def report(self):
+        if not self.available or self._first is None or self._last[0] <= self._first[0]:
+            return None
+        cpu_seconds = self._last[1] - self._first[1]
+        return {
+            'cpu_seconds': round(cpu_seconds, 2),
+            'cpu_avg_percent': round(100 * cpu_seconds / (self._last[0] - self._first[0]), 1),
+            'cpu_peak_percent': round(100 * self.cpu_peak, 1),
+            'rss_peak_mb': round(self.rss_peak / 2 ** 20, 1),
+        }
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.api = FakeBotApi(
+            latency=args.latency / 1000, jitter=args.jitter / 1000, error_rate=args.error_rate,
+            retry_after=args.retry_after, on_send=self._on_send, seed=args.seed,
+        )
+        self.loop = None
+        self.waiters = {}  # chat_id -> Future с временем ответа
+        self.latencies = defaultdict(list)
+        self.timeouts = Counter()
+        self.stray = 0  # ответы, которых никто не ждал (например, после таймаута)
+        self.expected = {}  # (chat_id, тема) -> срок первого повторения
+        self.reminder_lateness = []
+        self.reminder_times = []
+        self.extra_reminders = 0
+        self.rounds_done = 0
+
+    # Ответы бота приходят из потока FakeBotApi
+
+    def _on_send(self, ts, method, chat_id, params):
+        text = params.get('text') or params.get('caption') or ''
+        self.loop.call_soon_threadsafe(self._on_message, ts, chat_id, text)
+
+    def _on_message(self, ts, chat_id, text):
+        if text.startswith('🔔'):
+            self._on_reminder(ts, chat_id, text)
+            return
+        waiter = self.waiters.pop(chat_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(ts)
+        else:
+            self.stray += 1
+
+    def _on_reminder(self, ts, chat_id, text):
+        self.reminder_times.append(ts)
+        matched = [key for key in self.expected if key[0] == chat_id and key[1] in text]
+        if not matched:
+            self.extra_reminders += 1
+        for key in matched:
+            self.reminder_lateness.append(max(ts - self.expected.pop(key), 0))
+
+    # Виртуальные пользователи
+
+    async def step(self, user_id, name, text):
+        """Отправляет сообщение и ждёт ответа; время ответа (epoch) или None"""
+        waiter = self.loop.create_future()
+        self.waiters[user_id] = waiter
+        sent = time.time()
+        self.api.inject(make_update(user_id, text))
+        try:
+            replied = await asyncio.wait_for(waiter, self.args.reply_timeout)
+        except asyncio.TimeoutError:
+            self.waiters.pop(user_id, None)
+            self.timeouts[name] += 1
+            return None
+        self.latencies[name].append(replied - sent)
+        return replied
+
+    def study_date(self, user, round_number):
+        """Дата изучения, при которой первое повторение наступит во время теста"""
+        if self.args.no_reminders:
+            return 'сейчас', None
+        spread = max(self.args.reminder_spread, 1)
+        due_ts = self.first_due + ((user + round_number) % spread) * 60
+        return format_time(due_ts - INTERVALS[0].total_seconds()), due_ts
+
+    async def user(self, user):
+        user_id = BASE_USER_ID + user
+        rng = random.Random(self.args.seed * 1_000_003 + user)
+        await asyncio.sleep(self.args.ramp * user / max(self.args.users, 1))
+        for round_number in range(self.args.rounds):
+            name = f"Нагрузка u{user} r{round_number};"
+            date_text, due_ts = self.study_date(user, round_number)
+            script = (
+                ('newtopic', '/newtopic'), ('topic', name), ('date', date_text),
+                ('list', '/list'), ('done', '/done'), ('done_topic', '1'), ('done_rep', str(len(INTERVALS))),
+            )
+            for step_name, text in script:
+                if self.args.think:
+                    await asyncio.sleep(rng.expovariate(1 / self.args.think))
+                replied = await self.step(user_id, step_name, text)
+                if replied is None:
+                    break  # диалог сбился; следующий круг начнётся с /newtopic
+                # Если тема создана позже срока, напоминания о нём не будет
+                if step_name == 'date' and due_ts is not None and due_ts > replied + 1:
+                    self.expected[(user_id, name)] = due_ts
+            else:
+                self.rounds_done += 1
+
+    # Запуск
+
+    def start_bot(self, workdir, port):
+        env = dict(os.environ)
+        for name in ('WEBHOOK_URL', 'WEBHOOK_SECRET', 'SHARD_COUNT', 'SHARD_INDEX', 'DATA_FILE'):
+            env.pop(name, None)
+        env.update({
+            'BOT_TOKEN': BOT_TOKEN, 'BOT_API_URL': self.api.url, 'PORT': str(port),
+            'DB_FILE': os.path.join(workdir, 'loadtest.db'), 'STORAGE_BACKEND': 'sqlite',
+            'PYTHONUNBUFFERED': '1',
+        })
+        if self.args.mode == 'webhook':
+            env.update({'WEBHOOK_URL': f"http://127.0.0.1:{port}", 'WEBHOOK_SECRET': 'loadtest'})
+        log = open(os.path.join(workdir, 'bot.log'), 'w')
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT_DIR, 'main.py')], cwd=workdir, env=env,
+            stdout=log, stderr=subprocess.STDOUT,
+        )
+        return process, log
+
+    def wait_ready(self, process):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                return False
+            if self.args.mode == 'webhook' and self.api.webhook_url:
+                return True
+            if self.args.mode == 'polling' and self.api.calls['getUpdates']:
+                return True
+            time.sleep(0.1)
+        return False
+
+    async def drive(self, process):
+        self.loop = asyncio.get_running_loop()
+        sampler = ProcessSampler(process.pid)
+        sampling = asyncio.create_task(sampler.run())
+        self.first_due = math.ceil((time.time() + self.args.reminder_delay) / 60) * 60
+
+        started = time.time()
+        await asyncio.gather(*(self.user(user) for user in range(self.args.users)))
+        load_seconds = time.time() - started
+        print(f"🏁 Сценарии завершены за {load_seconds:.1f} с")
+
+        if self.expected:
+            last_due = max(self.expected.values())
+            print(f"⏳ Ждём напоминаний до {format_time(last_due)} МСК + {REMINDER_GRACE} с")
+            while self.expected and time.time() < last_due + REMINDER_GRACE:
+                await asyncio.sleep(0.5)
+        sampling.cancel()
+        sampler.sample()
+        return load_seconds, sampler.report()
+
+    def run(self):
+        self.api.start()
+        workdir = tempfile.mkdtemp(prefix='loadtest-')
+        port = free_port()
+        process, log = self.start_bot(workdir, port)
+        print(f"🧪 Bot API: {self.api.url}, бот: pid {process.pid}, режим {self.args.mode}, лог: {log.name}")
+        try:
+            if not self.wait_ready(process):
+                print("❌ Бот не запустился, см. лог")
+                return None
+            print(f"🚀 Нагрузка: {self.args.users} пользователей x {self.args.rounds} кругов")
+            load_seconds, process_stats = asyncio.run(self.drive(process))
+            metrics = scrape_metrics(port)
+        finally:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+                try:
+                    process.wait(STOP_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    print("⚠️ Бот не остановился за отведённое время, завершаем принудительно")
+                    process.kill()
+                    process.wait()
+            log.close()
+            self.api.stop()
+
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return self.report(load_seconds, process_stats, metrics, usage, process.returncode)
+
+    def report(self, load_seconds, process_stats, metrics, usage, returncode):
+        answered = sum(len(values) for values in self.latencies.values())
+        timeouts = sum(self.timeouts.values())
+        attempts = answered + timeouts
+        per_minute = Counter(int(ts // 60) for ts in self.reminder_times)
+        reminders_expected = len(self.reminder_lateness) + len(self.expected)
+        return {
+            'users': self.args.users, 'rounds': self.args.rounds, 'mode': self.args.mode,
+            'latency_ms': self.args.latency, 'jitter_ms': self.args.jitter, 'error_rate': self.args.error_rate,
+            'load_seconds': round(load_seconds, 2),
+            'updates': attempts,
+            'updates_per_sec': round(answered / load_seconds, 1) if load_seconds else None,
+            'rounds_completed': self.rounds_done,
+            'latency': percentiles([value for values in self.latencies.values() for value in values]),
+            'steps': {name: percentiles(self.latencies[name]) for name in STEPS if self.latencies[name]},
+            'errors': {
+                'timeouts': dict(self.timeouts),
+                'timeout_rate': round(timeouts / attempts, 4) if attempts else 0,
+                'handler_errors': int(metrics['bot_update_errors_total']),
+                'injected_429': dict(self.api.errors),
+                'send_given_up': int(metrics['bot_send_given_up_total']),
+                'stray_replies': self.stray,
+            },
+            'reminders': {
+                'expected': reminders_expected,
+                'delivered': len(self.reminder_lateness),
+                'missed': len(self.expected),
+                'extra': self.extra_reminders,
+                'lateness': percentiles(self.reminder_lateness),
+                'peak_per_minute': max(per_minute.values(), default=0),
+            },
+            'process': process_stats,
+            'process_total': {
+                'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 2),
+                'max_rss_mb': round(usage.ru_maxrss / 1024, 1),  # ru_maxrss в КиБ (Linux)
+                'returncode': returncode,
+            },
+            'api_calls': dict(self.api.calls),
+        }
+
+
+def print_report(report):
+    errors, reminders = report['errors'], report['reminders']
+    print(f"\n📊 {report['users']} пользователей x {report['rounds']} кругов, {report['mode']}, "
+          f"Bot API: {report['latency_ms']:.0f}±{report['jitter_ms']:.0f} мс, 429: {report['error_rate']:.1%}")
+    print(f"📨 Обновлений: {report['updates']} за {report['load_seconds']:.1f} с "
+          f"({report['updates_per_sec']}/с), кругов пройдено: {report['rounds_completed']}")
+    print(f"{'шаг':<14}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}{'ответов':>10}")
+    for name, stats in list(report['steps'].items()) + [('всего', report['latency'])]:
+        if stats:
+            print(f"{name:<14}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+                  f"{stats['max_ms']:>10.1f}{stats['count']:>10}")
+    print(f"❌ Таймауты: {sum(errors['timeouts'].values())} ({errors['timeout_rate']:.2%}), "
+          f"ошибки обработчиков: {errors['handler_errors']}, выдано 429: {sum(errors['injected_429'].values())}, "
+          f"недоставлено из очереди: {errors['send_given_up']}")
+    lateness = reminders['lateness']
+    lateness_text = (f", опоздание p50={lateness['p50_ms'] / 1000:.1f} p95={lateness['p95_ms'] / 1000:.1f} "
+                     f"max={lateness['max_ms'] / 1000:.1f} с" if lateness else "")
+    print(f"🔔 Напоминания: доставлено {reminders['delivered']} из {reminders['expected']}, "
+          f"пропало {reminders['missed']}{lateness_text}, пик {reminders['peak_per_minute']}/мин")
+    process, total = report['process'], report['process_total']
+    if process:
+        print(f"🖥️ Бот под нагрузкой: CPU {process['cpu_seconds']} с (в среднем {process['cpu_avg_percent']}%, "
+              f"пик {process['cpu_peak_percent']}% одного ядра), RSS до {process['rss_peak_mb']} МиБ")
+    print(f"🖥️ Бот за весь запуск: CPU {total['cpu_seconds']} с, пиковый RSS {total['max_rss_mb']} МиБ, "
+          f"код выхода {total['returncode']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=1, help="сколько раз каждый пользователь проходит сценарий")
+    parser.add_argument('--ramp', type=float, default=10, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument('--think', type=float, default=0, help="средняя пауза между шагами пользователя, с")
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    parser.add_argument('--latency', type=float, default=0, help="задержка ответов Bot API, мс")
+    parser.add_argument('--jitter', type=float, default=0, help="случайная добавка к задержке, до N мс")
+    parser.add_argument('--error-rate', type=float, default=0, help="доля отправок, получающих 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--reply-timeout', type=float, default=30, help="сколько ждать ответа на шаг, с")
+    parser.add_argument('--reminder-delay', type=float, default=60, help="через сколько секунд наступят первые сроки")
+    parser.add_argument('--reminder-spread', type=int, default=1, help="на сколько минут растянуть сроки")
+    parser.add_argument('--no-reminders', action='store_true', help="не проверять доставку напоминаний")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help="файл для отчёта в JSON")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    report = LoadTest(args).run()
+    if report is None:
+        sys.exit(1)
+    print_report(report)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Отчёт сохранён в {args.out}")
+
+
+if __name__ == '__main__':
+    main()
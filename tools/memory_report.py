@@ -0,0 +1,79 @@
+"""Сравнение памяти на тему: старые словари с datetime против model.Topic
+
+    python tools/memory_report.py [--topics 1000000] [--users 10000]
+
+Память меряется через tracemalloc по объектам, которые остаются живыми
+после построения набора данных.
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from main import INTERVALS  # noqa: E402
+from model import Topic, from_timestamp  # noqa: E402
+
+BASE_TS = 1_700_000_000
+
+
+def legacy_topic(index, study_ts):
+    """Тема в прежнем формате: словари и tz-aware datetime"""
+    study_date = from_timestamp(study_ts)
+    return {
+        'topic': f"Тема {index}",
+        'study_date': study_date,
+        'repetitions': [
+            {'date': study_date + interval, 'completed': bool(index & (1 << rep_index))}
+            for rep_index, interval in enumerate(INTERVALS)
+        ]
+    }
+
+
+def compact_topic(index, study_ts):
+    topic = Topic(index + 1, f"Тема {index}", study_ts,
+                  [study_ts + int(interval.total_seconds()) for interval in INTERVALS])
+    topic.done_mask = index & ((1 << len(INTERVALS)) - 1)
+    return topic
+
+
+def measure(factory, users, topics):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    data = {}
+    per_user = max(topics // users, 1)
+    for index in range(topics):
+        user_id = index // per_user
+        data.setdefault(user_id, []).append(factory(index, BASE_TS + index * 60))
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    gc.collect()
+    return current, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--topics', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=10_000)
+    args = parser.parse_args()
+
+    print(f"📊 {args.topics} тем, {args.users} пользователей, {len(INTERVALS)} повторений на тему\n")
+    results = {}
+    for label, factory in (('dict + datetime', legacy_topic), ('Topic (__slots__)', compact_topic)):
+        size, elapsed = measure(factory, args.users, args.topics)
+        results[label] = size
+        print(f"{label:<20} {size / 2**20:10.1f} МиБ  {size / args.topics:8.1f} байт/тема  ({elapsed:.1f} с)")
+
+    before, after = results.values()
+    print(f"\nЭкономия: {before / after:.1f}x, {(before - after) / args.topics:.0f} байт на тему")
+
+
+if __name__ == '__main__':
+    main()
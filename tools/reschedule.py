@@ -0,0 +1,106 @@
+"""Пересчёт сроков повторений всех тем после смены алгоритма или INTERVALS
+
+    SRS_ALGORITHM=sm2 python tools/reschedule.py [--db user_data.db] [--dry-run]
+    python tools/reschedule.py --synthetic 1000000 --algorithm sm2
+
+Бот во время пересчёта должен быть остановлен: он держит темы в памяти и
+перезаписал бы новые сроки. Изменившиеся темы сохраняются одной
+транзакцией. С --synthetic хранилище не трогается: скрипт строит N
+случайных тем и сравнивает пакетный пересчёт (numpy) с циклом по темам.
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import srs  # noqa: E402
+from main import DATA_FILE, DB_FILE, INTERVALS, SRS_ALGORITHM, STORAGE_BACKEND  # noqa: E402
+from model import Topic  # noqa: E402
+from storage import open_storage  # noqa: E402
+
+BASE_TS = 1_700_000_000
+
+
+def synthetic_topics(count, seed=1):
+    """Темы с частью выполненных повторений и случайной лёгкостью"""
+    rng = random.Random(seed)
+    topics = []
+    for index in range(count):
+        study_ts = BASE_TS + rng.randrange(60 * 86400)
+        topic = Topic(index + 1, f"Тема {index}", study_ts,
+                      [study_ts + int(interval.total_seconds()) for interval in INTERVALS])
+        for rep_index in range(rng.randrange(len(INTERVALS) + 1)):
+            topic.mark_done(rep_index)
+            topic.rep_ts[rep_index] += rng.randrange(3 * 86400)
+        topic.ease = rng.choice((1.3, 2.36, 2.5, 2.6, 2.8))
+        topics.append(topic)
+    return topics
+
+
+def run_synthetic(algorithm, count):
+    topics = synthetic_topics(count)
+    looped = copy.deepcopy(topics)
+
+    started = time.perf_counter()
+    changed = algorithm.plan_batch(topics)
+    batch_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    looped_changed = [topic for topic in looped if algorithm.plan(topic)]
+    loop_seconds = time.perf_counter() - started
+
+    mismatches = sum(1 for a, b in zip(topics, looped) if a.to_record() != b.to_record())
+    mode = 'numpy' if srs.np is not None else 'цикл (numpy не установлен)'
+    print(f"📊 {count} тем, алгоритм {algorithm.name}")
+    print(f"⚡ Пакетный пересчёт [{mode}]: {batch_seconds:.2f} с, изменено {len(changed)} тем")
+    print(f"🐢 Цикл по темам: {loop_seconds:.2f} с, изменено {len(looped_changed)} тем")
+    print(f"{'✅' if not mismatches else '❌'} Расхождений: {mismatches}")
+    return mismatches == 0
+
+
+def run_storage(algorithm, storage, dry_run):
+    started = time.perf_counter()
+    items = [
+        (user_id, Topic.from_record(record))
+        for user_id, records in storage.load().items()
+        for record in records
+    ]
+    print(f"📂 Загружено {len(items)} тем за {time.perf_counter() - started:.2f} с")
+
+    started = time.perf_counter()
+    changed = {id(topic) for topic in algorithm.plan_batch([topic for _, topic in items])}
+    print(f"⚡ Пересчёт ({algorithm.name}): {time.perf_counter() - started:.2f} с, изменено {len(changed)} тем")
+
+    if dry_run or not changed:
+        return
+    started = time.perf_counter()
+    storage.save_topics([(user_id, topic.to_record()) for user_id, topic in items if id(topic) in changed])
+    print(f"💾 Сохранено за {time.perf_counter() - started:.2f} с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--algorithm', default=SRS_ALGORITHM, choices=sorted(srs.ALGORITHMS))
+    parser.add_argument('--backend', default=STORAGE_BACKEND)
+    parser.add_argument('--db', default=DB_FILE)
+    parser.add_argument('--dry-run', action='store_true', help="только посчитать, ничего не сохранять")
+    parser.add_argument('--synthetic', type=int, help="пересчитать N случайных тем без хранилища")
+    args = parser.parse_args()
+
+    algorithm = srs.get_algorithm(args.algorithm, INTERVALS)
+    if args.synthetic:
+        sys.exit(0 if run_synthetic(algorithm, args.synthetic) else 1)
+
+    storage = open_storage(args.backend, args.db, DATA_FILE)
+    try:
+        run_storage(algorithm, storage, args.dry_run)
+    finally:
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Отправка синтетических обновлений на webhook-эндпоинт бота
+
+    WEBHOOK_SECRET=s python tools/webhook_harness.py --url http://localhost:5000/telegram \
+        --updates 1000 --users 100 --concurrency 16
+
+Бот должен быть запущен в режиме webhook с тем же WEBHOOK_SECRET. Чтобы
+ответы бота не уходили в настоящий Telegram, укажите боту BOT_API_URL
+локального сервера (см. tools/fake_bot_api.py). Скрипт проверяет, что
+запрос с неверным секретом отклоняется, и печатает задержку приёма.
+"""
+import argparse
+import itertools
+import json
+import os
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+COMMANDS = ['/start', '/list', '/newtopic', 'Синтетическая тема', 'сейчас', '/done']
+
+
+def make_update(update_id, user_id, text):
+    """Минимальное обновление Telegram с текстовым сообщением"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': update_id, 'message': message}
+
+
+def post(url, secret, payload):
+    """POST обновления; возвращает (HTTP-код, секунды)"""
+    body = json.dumps(payload).encode('utf-8')
+    req = urllib.request.Request(url, data=body, method='POST', headers={
+        'Content-Type': 'application/json',
+        'X-Telegram-Bot-Api-Secret-Token': secret,
+    })
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=10) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5000/telegram')
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET', ''))
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    status, _ = post(args.url, args.secret + 'x', make_update(0, 1, '/start'))
+    print(f"🔐 Неверный секрет: HTTP {status} ({'ok' if status == 403 else 'ОШИБКА'})")
+
+    # Каждый пользователь проходит команды по порядку
+    counter = itertools.count(1)
+    payloads = [
+        make_update(next(counter), 1_000_000 + index % args.users, COMMANDS[(index // args.users) % len(COMMANDS)])
+        for index in range(args.updates)
+    ]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda payload: post(args.url, args.secret, payload), payloads))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(seconds * 1000 for _, seconds in results)
+    errors = sum(1 for status, _ in results if status != 200)
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    print(f"📨 Отправлено {len(results)} обновлений за {elapsed:.2f} с ({len(results) / elapsed:.0f}/с), ошибок: {errors}")
+    print(f"⏱️ Задержка приёма, мс: p50={quantiles[49]:.1f} p95={quantiles[94]:.1f} p99={quantiles[98]:.1f} max={latencies[-1]:.1f}")
+
+
+if __name__ == '__main__':
+    main()
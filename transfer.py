@@ -0,0 +1,210 @@
+"""Импорт и экспорт тем в CSV и JSON
+
+Импорт принимает документ со списком тем и дат изучения:
+
+    CSV:  заголовок с колонками topic и study_date (или тема и дата),
+          разделитель - запятая, точка с запятой или табуляция
+    JSON: [{"topic": "...", "study_date": "..."}, ...] или {"topics": [...]}
+
+Дата - ДД.ММ.ГГГГ ЧЧ:ММ по Москве или ISO 8601. Документ проверяется
+целиком: если есть хоть одна ошибка, не импортируется ничего.
+
+Экспорт отдаёт те же колонки плюс состояние повторений: колонку
+completed (номера выполненных повторений через запятую) в CSV и список
+repetitions со сроками и отметками в JSON. Импорт их понимает, так что
+выгруженный файл можно загрузить обратно вместе с прогрессом. Время
+изучения выгружается с точностью до секунды, чтобы повторный импорт
+узнал уже существующие темы.
+"""
+import csv
+import io
+import json
+from datetime import datetime
+
+from model import from_timestamp, to_moscow
+
+MAX_BYTES = 4 * 1024 * 1024
+MAX_TOPICS = 5000
+MAX_NAME_LENGTH = 200
+MAX_ERRORS = 10  # сколько ошибок показывать пользователю
+
+NAME_COLUMNS = ('topic', 'name', 'тема')
+DATE_COLUMNS = ('study_date', 'date', 'дата')
+COMPLETED_COLUMNS = ('completed', 'выполнено')
+DATE_FORMAT = '%d.%m.%Y %H:%M'
+
+
+class TransferError(ValueError):
+    """Документ не прошёл проверку; errors - список строк для пользователя"""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def parse_date(value):
+    """ДД.ММ.ГГГГ ЧЧ:ММ или ISO 8601; наивное время считается московским"""
+    value = str(value).strip()
+    for parse in (lambda text: datetime.strptime(text, DATE_FORMAT), datetime.fromisoformat):
+        try:
+            return to_moscow(parse(value))
+        except ValueError:
+            continue
+    raise ValueError(f"неверная дата '{value[:40]}'")
+
+
+def _decode(data):
+    for encoding in ('utf-8-sig', 'cp1251'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    raise TransferError(["файл не в кодировке UTF-8 или Windows-1251"])
+
+
+def _pick(row, columns):
+    for column in columns:
+        if column in row:
+            return row[column]
+    return None
+
+
+def _rows_from_csv(text):
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(io.StringIO(text), dialect=dialect)
+    reader.fieldnames = [(name or '').strip().lower() for name in reader.fieldnames or []]
+    if not any(column in reader.fieldnames for column in NAME_COLUMNS) or \
+            not any(column in reader.fieldnames for column in DATE_COLUMNS):
+        raise TransferError(["в первой строке CSV нужны колонки topic и study_date"])
+    # Номер строки файла: заголовок - строка 1
+    return [
+        (reader.line_num, _pick(row, NAME_COLUMNS), _pick(row, DATE_COLUMNS), _pick(row, COMPLETED_COLUMNS), None)
+        for row in reader
+    ]
+
+
+def _rows_from_json(text):
+    try:
+        document = json.loads(text)
+    except ValueError as e:
+        raise TransferError([f"неверный JSON: {e}"])
+    if isinstance(document, dict):
+        document = document.get('topics')
+    if not isinstance(document, list):
+        raise TransferError(["JSON должен быть списком тем или объектом с ключом topics"])
+    rows = []
+    for number, item in enumerate(document, start=1):
+        if not isinstance(item, dict):
+            rows.append((number, None, None, None, None))
+            continue
+        item = {str(key).lower(): value for key, value in item.items()}
+        rows.append((
+            number, _pick(item, NAME_COLUMNS), _pick(item, DATE_COLUMNS),
+            _pick(item, COMPLETED_COLUMNS), item.get('repetitions'),
+        ))
+    return rows
+
+
+def parse_completed(value):
+    """Номера выполненных повторений ('1,2' или [1, 2]) -> индексы с нуля"""
+    if value is None or value == '':
+        return ()
+    parts = value if isinstance(value, list) else str(value).replace(';', ',').split(',')
+    indices = set()
+    for part in parts:
+        part = str(part).strip()
+        if not part:
+            continue
+        if not part.isdigit() or int(part) < 1:
+            raise ValueError(f"неверный номер повторения '{part[:20]}'")
+        indices.add(int(part) - 1)
+    return tuple(sorted(indices))
+
+
+def parse_repetitions(value):
+    """Список repetitions из JSON-выгрузки -> (сроки, индексы выполненных)"""
+    if not isinstance(value, list) or not all(isinstance(rep, dict) and 'date' in rep for rep in value):
+        raise ValueError("repetitions должен быть списком объектов с полем date")
+    dates = [parse_date(rep['date']) for rep in value]
+    completed = tuple(index for index, rep in enumerate(value) if rep.get('completed') is True)
+    return dates, completed
+
+
+def parse_import(data, filename=''):
+    """Темы из документа или TransferError
+
+    Возвращает [(название, дата изучения, индексы выполненных повторений,
+    сроки повторений или None)]; сроки есть только в JSON-выгрузке.
+    """
+    if len(data) > MAX_BYTES:
+        raise TransferError([f"файл больше {MAX_BYTES // 1024} КБ"])
+    text = _decode(bytes(data))
+    is_json = filename.lower().endswith('.json') or text.lstrip()[:1] in ('[', '{')
+    rows = _rows_from_json(text) if is_json else _rows_from_csv(text)
+    if not rows:
+        raise TransferError(["в файле нет тем"])
+    if len(rows) > MAX_TOPICS:
+        raise TransferError([f"слишком много тем: {len(rows)}, максимум {MAX_TOPICS}"])
+
+    topics, errors = [], []
+    label = "тема" if is_json else "строка"
+    for number, name, date, completed, repetitions in rows:
+        name = str(name).strip() if name is not None else ''
+        if not name:
+            errors.append(f"{label} {number}: нет названия темы")
+            continue
+        if len(name) > MAX_NAME_LENGTH:
+            errors.append(f"{label} {number}: название длиннее {MAX_NAME_LENGTH} символов")
+            continue
+        if date is None or not str(date).strip():
+            errors.append(f"{label} {number}: нет даты изучения")
+            continue
+        try:
+            rep_dates = None
+            if repetitions is not None:
+                rep_dates, completed = parse_repetitions(repetitions)
+            else:
+                completed = parse_completed(completed)
+            topics.append((name, parse_date(date), completed, rep_dates))
+        except ValueError as e:
+            errors.append(f"{label} {number}: {e}")
+    if errors:
+        raise TransferError(errors)
+    return topics
+
+
+def _completed(topic):
+    return ",".join(str(index + 1) for index in range(len(topic)) if topic.is_done(index))
+
+
+def _next_due(topic):
+    pending = topic.pending()
+    return from_timestamp(min(ts for _, ts in pending)).strftime(DATE_FORMAT) if pending else ''
+
+
+def export_csv(topics):
+    """CSV (UTF-8 с BOM, чтобы Excel показал кириллицу) со всеми темами"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['topic', 'study_date', 'completed', 'next_repetition'])
+    for topic in topics:
+        writer.writerow([topic.name, topic.study_date.isoformat(), _completed(topic), _next_due(topic)])
+    return out.getvalue().encode('utf-8-sig')
+
+
+def export_json(topics):
+    """JSON со всеми темами и повторениями, даты в ISO 8601"""
+    return json.dumps([
+        {
+            'topic': topic.name,
+            'study_date': topic.study_date.isoformat(),
+            'repetitions': [
+                {'date': topic.rep_date(index).isoformat(), 'completed': topic.is_done(index)}
+                for index in range(len(topic))
+            ],
+        }
+        for topic in topics
+    ], ensure_ascii=False, indent=2).encode('utf-8')